@@ -3,6 +3,8 @@ from .hierarchy import (Cluster,
                        )
 from .rows import (RowKey,
                    )
+from .session import (Session,
+                     )
 
 from .models import (Model,
                      Index,
@@ -0,0 +1,40 @@
+import random
+import threading
+
+class LatencyAwarePolicy(object):
+    """Prefers the servers that answered fastest lately. Every server is scored
+       by an exponentially weighted moving average of its latency, multiplied
+       by the number of requests it is still working on. Servers we haven't
+       heard from yet score best, so they get measured."""
+    def __init__(self, decay=0.3):
+        self.decay = decay
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._outstanding = {}
+
+    def score(self, server):
+        return self._latency.get(server, 0.0) * (self._outstanding.get(server, 0) + 1)
+
+    def order(self, servers):
+        servers = list(servers)
+        random.shuffle(servers) # don't let ties always pick the same server
+        servers.sort(key=self.score)
+        return servers
+
+    def started(self, server):
+        with self._lock:
+            self._outstanding[server] = self._outstanding.get(server, 0) + 1
+
+    def finished(self, server, latency):
+        with self._lock:
+            self._outstanding[server] = max(0, self._outstanding.get(server, 1) - 1)
+            average = self._latency.get(server)
+            if average is None:
+                self._latency[server] = latency
+            else:
+                self._latency[server] = self.decay * latency + (1 - self.decay) * average
+
+    def stats(self):
+        with self._lock:
+            return dict((server, (self._latency.get(server), self._outstanding.get(server, 0)))
+                        for server in set(self._latency) | set(self._outstanding))
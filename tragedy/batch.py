@@ -0,0 +1,145 @@
+import threading
+
+_local = threading.local()
+
+def current_batch(keyspace):
+    """The innermost Batch of this thread for keyspace, or None."""
+    for batch in reversed(getattr(_local, 'batches', ())):
+        if batch.keyspace is keyspace:
+            return batch
+    return None
+
+def count_mutations(mutation_map):
+    return sum(len(mutations) for cfs in mutation_map.values() for mutations in cfs.values())
+
+def merge_mutation_map(into, mutation_map):
+    for row_key, cfs in mutation_map.iteritems():
+        for column_family, mutations in cfs.iteritems():
+            into.setdefault(row_key, {}).setdefault(column_family, []).extend(mutations)
+    return into
+
+def coalesce_mutation_map(into, mutation_map, positions):
+    """Like merge_mutation_map, but a column that's in into already isn't
+       written twice: the one with the higher clock is kept, like Cassandra
+       would. positions maps (row_key, column_family, column name) to the
+       column's index in into, and is kept up to date. Returns how many
+       mutations were saved."""
+    saved = 0
+    for row_key, cfs in mutation_map.iteritems():
+        for column_family, mutations in cfs.iteritems():
+            merged = into.setdefault(row_key, {}).setdefault(column_family, [])
+            for mutation in mutations:
+                column = mutation.column_or_supercolumn and mutation.column_or_supercolumn.column
+                if column is None: # deletions and super columns go out as they are
+                    merged.append(mutation)
+                    continue
+                position = positions.get((row_key, column_family, column.name))
+                if position is None:
+                    positions[(row_key, column_family, column.name)] = len(merged)
+                    merged.append(mutation)
+                    continue
+                saved += 1
+                if merged[position].column_or_supercolumn.column.clock.timestamp <= column.clock.timestamp:
+                    merged[position] = mutation
+    return saved
+
+def chunk_mutation_map(mutation_map, size=None):
+    """Split mutation_map into mutation_maps of at most size mutations each.
+       Rows with more than size mutations are split up too."""
+    if not size:
+        yield mutation_map
+        raise StopIteration
+    chunk, count = {}, 0
+    for row_key, cfs in mutation_map.iteritems():
+        for column_family, mutations in cfs.iteritems():
+            for i in xrange(0, len(mutations), size):
+                part = mutations[i:i+size]
+                if count + len(part) > size:
+                    yield chunk
+                    chunk, count = {}, 0
+                chunk.setdefault(row_key, {}).setdefault(column_family, []).extend(part)
+                count += len(part)
+    if chunk:
+        yield chunk
+
+def send_mutation_map(client, mutation_map, consistency_level):
+    """Send a mutation_map, split up by the servers that own its row keys."""
+    for server, row_keys in client.split_keys(mutation_map.keys()):
+        client.on(server).batch_mutate(
+                                       mutation_map=dict((k, mutation_map[k]) for k in row_keys),
+                                       consistency_level=consistency_level,
+                                      )
+
+class Batch(object):
+    """A unit of work for one keyspace, see Keyspace.batch(). While it's active
+       in a thread, every batch_mutate of the keyspace's models (saves, mirrors,
+       index maintenance, ...) ends up in one mutation_map, where repeated
+       writes of a column are coalesced to the latest one, which is sent when
+       the block is left without an exception. With max_mutations, it is sent
+       in chunks of at most that many mutations."""
+    def __init__(self, keyspace, max_mutations=None, consistency_level=None):
+        self.keyspace = keyspace
+        self.max_mutations = max_mutations
+        self.consistency_level = consistency_level
+        self._mutation_maps = {} # consistency_level -> mutation_map
+        self._positions = {} # consistency_level -> positions, see coalesce_mutation_map
+        self._written = set() # (model, row_key), to invalidate once it's sent
+        self._saved = [] # (row, row_key, columns), to mark as saved once it's sent
+
+    def __enter__(self):
+        if getattr(_local, 'batches', None) is None:
+            _local.batches = []
+        _local.batches.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.batches.remove(self)
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+    def __len__(self):
+        return sum(count_mutations(mutation_map) for mutation_map in self._mutation_maps.values())
+
+    def add(self, model, mutation_map, consistency_level):
+        consistency_level = self.consistency_level or consistency_level
+        coalesce_mutation_map(self._mutation_maps.setdefault(consistency_level, {}), mutation_map,
+                              self._positions.setdefault(consistency_level, {}))
+        self._written.update((model, row_key) for row_key in mutation_map)
+
+    def saved(self, row, row_key):
+        """row saved its changed columns to row_key into this batch. They only
+           stop counting as changed when the batch is sent, so if it's
+           discarded, saving row again writes them again."""
+        self._saved.append((row, row_key, row._changed_columns()))
+
+    def has_column(self, column_family, row_key, column_key):
+        """True if we're about to write column_key to row_key."""
+        for mutation_map in self._mutation_maps.values():
+            for mutation in mutation_map.get(row_key, {}).get(column_family, ()):
+                column = mutation.column_or_supercolumn and mutation.column_or_supercolumn.column
+                if column is not None and column.name == column_key:
+                    return True
+        return False
+
+    def flush(self):
+        mutation_maps, self._mutation_maps = self._mutation_maps, {}
+        self._positions = {}
+        written, self._written = self._written, set()
+        saved, self._saved = self._saved, []
+        client = self.keyspace.getclient()
+        for consistency_level, mutation_map in mutation_maps.items():
+            for chunk in chunk_mutation_map(mutation_map, self.max_mutations):
+                send_mutation_map(client, chunk, consistency_level)
+        for model, row_key in written:
+            model._invalidate(row_key)
+        for row, row_key, columns in saved:
+            row._saved(row_key, columns)
+
+    def discard(self):
+        self._mutation_maps.clear()
+        self._positions.clear()
+        self._written.clear()
+        del self._saved[:]
@@ -0,0 +1,122 @@
+import threading
+import time
+
+from .datastructures import OrderedDict
+
+_missing = object()
+
+class ExpiringCache(object):
+    """A thread safe LRU cache whose entries expire after ttl seconds.
+       Holds at most max_entries entries and, if sizeof(key, value) is given,
+       at most max_bytes of them; the least recently used go first.
+       group(key) puts keys in groups that can be dropped all at once.
+
+       To cache what was read while someone else might drop it, take a
+       token() before reading and pass it to set(): if the key (or its
+       group) was dropped in between, the value isn't stored."""
+    def __init__(self, max_entries=10000, ttl=None, max_bytes=None, sizeof=None, group=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.group = group
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (expires, value, size), least recently used first
+        self._groups = {}
+        self._bytes = 0
+        self._epoch = 0 # counts drops
+        self._dropped = OrderedDict() # key or group -> epoch of its last drop, oldest first
+        self._forgotten = 0 # the newest epoch we no longer remember the drops of
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _missing)
+            if entry is _missing:
+                self.stats['misses'] += 1
+                return default
+            if entry[0] is not None and entry[0] < time.time():
+                self._remove(key)
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return default
+            del self._entries[key] # move to the end, it's the most recently used now
+            self._entries[key] = entry
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def token(self):
+        with self._lock:
+            return self._epoch
+
+    def set(self, key, value, token=None):
+        expires = time.time() + self.ttl if self.ttl else None
+        size = self.sizeof(key, value) if self.sizeof else 0
+        with self._lock:
+            if token is not None and self._dropped_since(key, token):
+                return
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return # it would push out everything else
+            self._entries[key] = (expires, value, size)
+            self._bytes += size
+            if self.group:
+                self._groups.setdefault(self.group(key), set()).add(key)
+            while len(self._entries) > self.max_entries or \
+                  (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(iter(self._entries).next())
+                self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        expires, value, size = self._entries.pop(key)
+        self._bytes -= size
+        if self.group:
+            group = self._groups.get(self.group(key))
+            group.discard(key)
+            if not group:
+                del self._groups[self.group(key)]
+
+    def _dropped_since(self, key, token):
+        if token == self._epoch:
+            return False
+        if token < self._forgotten:
+            return True # can't tell, better safe than stale
+        if self._dropped.get(key, -1) > token:
+            return True
+        return bool(self.group) and self._dropped.get(self.group(key), -1) > token
+
+    def _record_drop(self, name):
+        self._epoch += 1
+        self._dropped.pop(name, None)
+        self._dropped[name] = self._epoch
+        while len(self._dropped) > self.max_entries:
+            self._forgotten = self._dropped.popitem(last=False)[1]
+
+    def drop(self, key):
+        with self._lock:
+            self._record_drop(key)
+            if key in self._entries:
+                self._remove(key)
+
+    def drop_group(self, group):
+        with self._lock:
+            self._record_drop(group)
+            for key in list(self._groups.get(group, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+            self._bytes = 0
+            self._epoch += 1
+            self._dropped.clear()
+            self._forgotten = self._epoch
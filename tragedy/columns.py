@@ -5,6 +5,7 @@ from datetime import datetime
 import simplejson as json
 from .exceptions import TragedyException
 from .hierarchy import cmcache
+from .session import current_session
 
 class BaseField(object):
     def set_owner_and_name(self, owner, name):
@@ -139,6 +140,9 @@ class ForeignKey(Field):
         super(ForeignKey, self).__init__(self, *args, **kwargs)
         
     def value_to_external(self, row_key):
+        session = current_session()
+        if session is not None and session.get(self.foreign_class, row_key) is not None:
+            return session.get(self.foreign_class, row_key)
         instance = self.foreign_class(row_key=row_key)
         if self.resolve:
             instance.multiget_slice()
@@ -19,6 +19,8 @@
 
 import socket
 import threading
+import time
+from contextlib import contextmanager
 from Queue import Queue
 
 import pkg_resources
@@ -30,9 +32,18 @@ from thrift.protocol import TBinaryProtocol
 from cassandra import Cassandra
 
 from .util import unhandled_exception_handler
-from .exceptions import NoServerAvailable
-
-__all__ = ['connect', 'connect_thread_local', 'NoServerAvailable']
+from .pipeline import Pipeline
+from .ring import Ring
+from .health import HealthTracker
+from .retry import (RetryPolicies,
+                    TRANSPORT_ERRORS,
+                   )
+from .datastructures import OrderedDict
+from .exceptions import (NoServerAvailable,
+                         PoolTimeout,
+                        )
+
+__all__ = ['connect', 'connect_thread_local', 'connect_pool', 'NoServerAvailable', 'PoolTimeout']
 
 DEFAULT_SERVER = 'localhost:9160'
 
@@ -47,18 +58,49 @@ def create_client_transport(server, framed_transport, timeout):
         transport = TTransport.TBufferedTransport(socket)
     protocol = TBinaryProtocol.TBinaryProtocolAccelerated(transport)
     client = Cassandra.Client(protocol)
+    client.__dict__['tsocket'] = socket
     transport.open()
 
     return client, transport
 
-def connect(servers=None, framed_transport=False, timeout=None):
+@contextmanager
+def call_timeout(client, timeout, default):
+    """Use another socket timeout for one call."""
+    if timeout is None:
+        yield
+        return
+    client.tsocket.setTimeout(timeout*1000.0)
+    try:
+        yield
+    finally:
+        client.tsocket.setTimeout(default*1000.0 if default is not None else None)
+
+def went_stale(exc, reused):
+    """A connection we have used before may just have been dropped while it
+       sat idle, e.g. because the server restarted. That's worth one fresh
+       connection to the same server before we call it down. A timeout isn't:
+       the server is slow."""
+    return reused and not isinstance(exc, socket.timeout)
+
+def timed_call(balancer, server, client, attr, args, kwargs):
+    if balancer is None:
+        return getattr(client, attr)(*args, **kwargs)
+    
+    balancer.started(server)
+    start = time.time()
+    try:
+        return getattr(client, attr)(*args, **kwargs)
+    finally:
+        balancer.finished(server, time.time() - start)
+
+def connect(servers=None, framed_transport=False, timeout=None, health=None, retry=None):
     """
     Constructs a single Cassandra connection. Initially connects to the first
     server on the list.
     
-    If the connection fails, it will attempt to connect to each server on the
-    list in turn until one succeeds. If it is unable to find an active server,
-    it will throw a NoServerAvailable exception.
+    If the connection fails, the call is retried on the next server that isn't
+    down, as often as the RetryPolicy for the operation allows. If it is unable
+    to find an active server, it will throw a NoServerAvailable exception.
 
     Parameters
     ----------
@@ -72,6 +114,15 @@ def connect(servers=None, framed_transport=False, timeout=None):
               Timeout in seconds (e.g. 0.5)
 
               Default: None (it will stall forever)
+    health: HealthTracker
+              Keeps track of failed servers and when to retry them.
+
+              Default: a HealthTracker of its own
+    retry: RetryPolicies
+              How often reads, writes and schema changes are tried, and with
+              what timeout.
+
+              Default: RetryPolicies()
 
     Returns
     -------
@@ -80,18 +131,19 @@ def connect(servers=None, framed_transport=False, timeout=None):
 
     if servers is None:
         servers = [DEFAULT_SERVER]
-    client = SingleConnection(servers, framed_transport, timeout)
+    client = SingleConnection(servers, framed_transport, timeout, health, retry)
     return client
 
-def connect_thread_local(servers=None, round_robin=True, framed_transport=False, timeout=None):
+def connect_thread_local(servers=None, round_robin=True, framed_transport=False, timeout=None, health=None,
+                         balancer=None, retry=None):
     """
     Constructs a Cassandra connection for each thread. By default, it attempts
     to connect in a round_robin (load-balancing) fashion. Turn it off by
     setting round_robin=False
 
-    If the connection fails, it will attempt to connect to each server on the
-    list in turn until one succeeds. If it is unable to find an active server,
-    it will throw a NoServerAvailable exception.
+    If the connection fails, the call is retried on the next server that isn't
+    down, as often as the RetryPolicy for the operation allows. If it is unable
+    to find an active server, it will throw a NoServerAvailable exception.
 
     Parameters
     ----------
@@ -108,6 +160,81 @@ def connect_thread_local(servers=None, round_robin=True, framed_transport=False,
               Timeout in seconds (e.g. 0.5 for half a second)
 
               Default: None (it will stall forever)
+    health: HealthTracker
+              Keeps track of failed servers and when to retry them.
+
+              Default: a HealthTracker of its own
+    balancer: LatencyAwarePolicy
+              Picks the servers new connections go to, instead of round_robin.
+
+              Default: None
+    retry: RetryPolicies
+              How often reads, writes and schema changes are tried, and with
+              what timeout.
+
+              Default: RetryPolicies()
+
+    Returns
+    -------
+    Cassandra client
+    """
+
+    if servers is None:
+        servers = [DEFAULT_SERVER]
+    return ThreadLocalConnection(servers, round_robin, framed_transport, timeout, health, balancer, retry)
+
+def connect_pool(servers=None, framed_transport=False, timeout=None, pool_size=5,
+                 max_overflow=10, pool_timeout=30, recycle=10000, idle_timeout=600, health=None,
+                 balancer=None, retry=None):
+    """
+    Constructs a bounded pool of Cassandra connections that is shared by all
+    threads. Each call checks a connection out of the pool, and returns it
+    when it's done. New connections are opened round robin over the servers.
+
+    If the connection fails, the call is retried on the next server that isn't
+    down, as often as the RetryPolicy for the operation allows. If it is unable
+    to find an active server, it will throw a NoServerAvailable exception.
+
+    Parameters
+    ----------
+    servers : [server]
+              List of Cassandra servers with format: "hostname:port"
+
+              Default: ['localhost:9160']
+    framed_transport: bool
+              If True, use a TFramedTransport instead of a TBufferedTransport
+    timeout: float
+              Timeout in seconds (e.g. 0.5)
+
+              Default: None (it will stall forever)
+    pool_size: int
+              Number of idle connections kept open.
+    max_overflow: int
+              Number of connections that may be opened on top of pool_size
+              under load. They are closed when they are returned.
+    pool_timeout: float
+              Seconds to wait for a free connection before throwing a
+              PoolTimeout exception. None waits forever.
+    recycle: int
+              Close and replace a connection after it served this many
+              requests. None never recycles.
+    idle_timeout: float
+              Close connections that have been idle for this many seconds.
+              None keeps them forever.
+    health: HealthTracker
+              Keeps track of failed servers and when to retry them.
+
+              Default: a HealthTracker of its own
+    balancer: LatencyAwarePolicy
+              Picks the servers for new connections and checkouts, instead of
+              round robin.
+
+              Default: None
+    retry: RetryPolicies
+              How often reads, writes and schema changes are tried, and with
+              what timeout.
+
+              Default: RetryPolicies()
 
     Returns
     -------
@@ -116,14 +243,85 @@ def connect_thread_local(servers=None, round_robin=True, framed_transport=False,
 
     if servers is None:
         servers = [DEFAULT_SERVER]
-    return ThreadLocalConnection(servers, round_robin, framed_transport, timeout)
+    return ConnectionPool(servers, framed_transport, timeout, pool_size, max_overflow,
+                          pool_timeout, recycle, idle_timeout, health, balancer, retry)
+
+class BaseConnection(object):
+    """What every connection offers besides the Cassandra API. Connections
+       that don't know the token ring send every request to one server."""
+    _ring = None
+    # May more than one thread use this connection at the same time?
+    thread_safe = False
+    
+    def __getattr__(self, attr):
+        def client_call(*args, **kwargs):
+            return self._call(attr, args, kwargs)
+
+        setattr(self, attr, client_call)
+        return getattr(self, attr)
 
-class SingleConnection(object):
-    def __init__(self, servers, framed_transport, timeout):
+    def _call(self, attr, args, kwargs, server=None):
+        policy = self._retry.policy_for(attr)
+        try:
+            return policy.call(lambda timeout: self._attempt(attr, args, kwargs, server, timeout))
+        except TRANSPORT_ERRORS, exc:
+            # we tried as often as we may, and no server was able to answer.
+            raise NoServerAvailable()
+
+    def _attempt(self, attr, args, kwargs, server=None, timeout=None):
+        """Try a call once. Connection errors mark the server down and go
+           to the RetryPolicy, which decides whether to try again."""
+        raise NotImplementedError()
+
+    @contextmanager
+    def pipeline(self, server=None):
+        """Calls made on the pipeline return Futures. When the block ends
+           they are all sent back to back on one connection, and then their
+           answers are read. Pipelined calls aren't retried."""
+        with self._raw_client(server) as client:
+            pipe = Pipeline(client)
+            yield pipe
+            pipe.execute()
+
+    @contextmanager
+    def _raw_client(self, server=None):
+        """A Cassandra.Client for our exclusive use."""
+        raise NotImplementedError()
+    
+    def split_keys(self, keys):
+        return [(None, keys)]
+    
+    def on(self, server):
+        return self
+
+    def hedge_servers(self, server, keys):
+        """The server to read keys from, and a second one to hedge the read
+           with. We can't hedge without a pool to run both reads at once."""
+        return server, None
+
+    def set_servers(self, servers):
+        self._servers = list(servers)
+
+    def refresh_ring(self, keyspace, route=True, discover=False):
+        """Ask the cluster for its token ring. If discover is set, the servers
+           we know about are replaced by all endpoints found in the ring."""
+        port = self._servers[0].split(':')[1]
+        ring = Ring.from_client(self, keyspace, port)
+        if discover and ring.servers():
+            self.set_servers(ring.servers())
+        if route:
+            self._ring = ring
+        return ring
+
+class SingleConnection(BaseConnection):
+    def __init__(self, servers, framed_transport, timeout, health=None, retry=None):
         self._servers = servers
         self._client = None
+        self._server = None
         self._framed_transport = framed_transport
         self._timeout = timeout
+        self._health = health or HealthTracker()
+        self._retry = retry or RetryPolicies()
         self._keyspace_set = None
 
     def set_keyspace(self, keyspace):
@@ -131,50 +329,76 @@ class SingleConnection(object):
         if self._client and not self._client.__dict__.get('keyspace_already_set'):
             self.__getattr__('set_keyspace')(keyspace)
 
-    def __getattr__(self, attr):
-        def client_call(*args, **kwargs):
-            if self._client is None:
-                self._find_server()
+    def _attempt(self, attr, args, kwargs, server=None, timeout=None):
+        reused = self._client is not None
+        if not reused:
+            self._find_server()
+        while True:
             try:
-                return getattr(self._client, attr)(*args, **kwargs)
-            except (Thrift.TException, socket.timeout, socket.error), exc:
+                with call_timeout(self._client, timeout, self._timeout):
+                    result = getattr(self._client, attr)(*args, **kwargs)
+            except TRANSPORT_ERRORS, exc:
                 unhandled_exception_handler()
-                # Connection error, try to connect to all the servers
+                server = self._server
                 self._transport.close()
                 self._client = None
-
-                for server in self._servers:
-                    try:
-                        self._client, self._transport = create_client_transport(server, self._framed_transport, self._timeout)
-                        return getattr(self._client, attr)(*args, **kwargs)
-                    except (Thrift.TException, socket.timeout, socket.error), exc:
-                        unhandled_exception_handler()
-                        continue
-                self._client = None
-                raise NoServerAvailable()
+                if not went_stale(exc, reused):
+                    # Connection error, the next attempt goes to a server that isn't down
+                    self._health.mark_down(server)
+                    raise
+                reused = False
+                self._reconnect(server)
+                continue
             except:
                 unhandled_exception_handler()
                 raise
-
-        setattr(self, attr, client_call)
-        return getattr(self, attr)
+            self._health.mark_up(self._server)
+            return result
+
+    @contextmanager
+    def _raw_client(self, server=None):
+        reused = self._client is not None
+        if not reused:
+            self._find_server()
+        try:
+            yield self._client
+        except TRANSPORT_ERRORS, exc:
+            if not went_stale(exc, reused):
+                self._health.mark_down(self._server)
+            self._transport.close()
+            self._client = None
+            raise
+
+    def _reconnect(self, server):
+        try:
+            self._open(server)
+        except TRANSPORT_ERRORS, exc:
+            self._health.mark_down(server)
+            raise
+
+    def _open(self, server):
+        self._client, self._transport = create_client_transport(server, self._framed_transport, self._timeout)
+        self._server = server
+        if self._keyspace_set:
+            self._client.set_keyspace(self._keyspace_set)
+            self._client.__dict__['keyspace_already_set'] = True
 
     def _find_server(self):
-        for server in self._servers:
+        for server in self._health.candidates(self._servers):
             try:
-                self._client, self._transport = create_client_transport(server, self._framed_transport, self._timeout)
-                if self._keyspace_set:
-                    self.__getattr__('set_keyspace')(self._keyspace_set)
-                    self._client.__dict__['keyspace_already_set'] = True
+                self._open(server)
                 return
-            except (Thrift.TException, socket.timeout, socket.error), exc:
+            except TRANSPORT_ERRORS, exc:
                 unhandled_exception_handler()
+                self._health.mark_down(server)
                 continue
         self._client = None
         raise NoServerAvailable()
 
-class ThreadLocalConnection(object):
-    def __init__(self, servers, round_robin, framed_transport, timeout):
+class ThreadLocalConnection(BaseConnection):
+    thread_safe = True
+
+    def __init__(self, servers, round_robin, framed_transport, timeout, health=None, balancer=None, retry=None):
         self._servers = servers
         self._queue = Queue()
         for i in xrange(len(servers)):
@@ -183,59 +407,388 @@ class ThreadLocalConnection(object):
         self._round_robin = round_robin
         self._framed_transport = framed_transport
         self._timeout = timeout
+        self._health = health or HealthTracker()
+        self._balancer = balancer
+        self._retry = retry or RetryPolicies()
         self._keyspace_set = None
 
     def set_keyspace(self, keyspace):
         self._keyspace_set = keyspace
-        if self._local_client and not self._local_client.__dict__.get('keyspace_already_set'):
+        client = getattr(self._local, 'client', None)
+        if client and not client.__dict__.get('keyspace_already_set'):
             self.__getattr__('set_keyspace')(keyspace)
 
-    def __getattr__(self, attr):
-        def client_call(*args, **kwargs):
-            if getattr(self._local, 'client', None) is None:
-                self._find_server()
+    def _attempt(self, attr, args, kwargs, server=None, timeout=None):
+        reused = getattr(self._local, 'client', None) is not None
+        if not reused:
+            self._find_server()
 
+        while True:
             try:
-                return getattr(self._local.client, attr)(*args, **kwargs)
-            except (Thrift.TException, socket.timeout, socket.error), exc:
-                # Connection error, try to connect to all the servers
+                with call_timeout(self._local.client, timeout, self._timeout):
+                    result = timed_call(self._balancer, self._local.server, self._local.client, attr, args, kwargs)
+            except TRANSPORT_ERRORS, exc:
+                server = self._local.server
                 self._local.transport.close()
                 self._local.client = None
+                if not went_stale(exc, reused):
+                    # Connection error, the next attempt goes to a server that isn't down
+                    self._health.mark_down(server)
+                    raise
+                reused = False
+                self._reconnect(server)
+                continue
+            self._health.mark_up(self._local.server)
+            return result
 
-                servers = self._round_robin_servers()
-
-                for server in servers:
-                    try:
-                        self._local.client, self._local.transport = create_client_transport(server, self._framed_transport, self._timeout)
-                        return getattr(self._local.client, attr)(*args, **kwargs)
-                    except (Thrift.TException, socket.timeout, socket.error), exc:
-                        continue
-                self._local.client = None
-                raise NoServerAvailable()
-
-        setattr(self, attr, client_call)
-        return getattr(self, attr)
+    def set_servers(self, servers):
+        queue = Queue()
+        for i in xrange(len(servers)):
+            queue.put(i)
+        self._servers, self._queue = list(servers), queue
 
     def _round_robin_servers(self):
         servers = self._servers
-        if self._round_robin:
+        if self._balancer:
+            servers = self._balancer.order(servers)
+        elif self._round_robin:
             i = self._queue.get()
             self._queue.put(i)
             servers = servers[i:]+servers[:i]
 
         return servers
 
+    @contextmanager
+    def _raw_client(self, server=None):
+        reused = getattr(self._local, 'client', None) is not None
+        if not reused:
+            self._find_server()
+        try:
+            yield self._local.client
+        except TRANSPORT_ERRORS, exc:
+            if not went_stale(exc, reused):
+                self._health.mark_down(self._local.server)
+            self._local.transport.close()
+            self._local.client = None
+            raise
+
+    def _reconnect(self, server):
+        try:
+            self._open(server)
+        except TRANSPORT_ERRORS, exc:
+            self._health.mark_down(server)
+            raise
+
+    def _open(self, server):
+        self._local.client, self._local.transport = create_client_transport(server, self._framed_transport, self._timeout)
+        self._local.server = server
+        if self._keyspace_set:
+            self._local.client.set_keyspace(self._keyspace_set)
+            self._local.client.__dict__['keyspace_already_set'] = True
+
     def _find_server(self):
         servers = self._round_robin_servers()
 
-        for server in servers:
+        for server in self._health.candidates(servers):
             try:
-                self._local.client, self._local.transport = create_client_transport(server, self._framed_transport, self._timeout)
-                if self._keyspace_set:
-                    self._local_client.__getattr__('set_keyspace')(self._keyspace_set)
-                    self._local_client.__dict__['keyspace_already_set'] = True
+                self._open(server)
                 return
-            except (Thrift.TException, socket.timeout, socket.error), exc:
+            except TRANSPORT_ERRORS, exc:
+                self._health.mark_down(server)
                 continue
         self._local.client = None
         raise NoServerAvailable()
+
+class PooledConnection(object):
+    def __init__(self, server, framed_transport, timeout):
+        self.server = server
+        self.client, self.transport = create_client_transport(server, framed_transport, timeout)
+        self.keyspace = None
+        self.requests = 0
+        self.last_used = time.time()
+
+    def close(self):
+        try:
+            self.transport.close()
+        except TRANSPORT_ERRORS, exc:
+            pass
+
+class BoundConnection(object):
+    """Sends all calls through the pool to one specific server."""
+    def __init__(self, pool, server):
+        self._pool = pool
+        self._server = server
+
+    def __getattr__(self, attr):
+        def client_call(*args, **kwargs):
+            return self._pool._call(attr, args, kwargs, server=self._server)
+        
+        setattr(self, attr, client_call)
+        return getattr(self, attr)
+
+class ConnectionPool(BaseConnection):
+    thread_safe = True
+
+    def __init__(self, servers, framed_transport, timeout, pool_size, max_overflow,
+                 pool_timeout, recycle, idle_timeout, health=None, balancer=None, retry=None):
+        self._servers = servers
+        self._queue = Queue()
+        for i in xrange(len(servers)):
+            self._queue.put(i)
+        self._framed_transport = framed_transport
+        self._timeout = timeout
+        self._pool_size = pool_size
+        self._max_overflow = max_overflow
+        self._pool_timeout = pool_timeout
+        self._recycle = recycle
+        self._idle_timeout = idle_timeout
+        self._health = health or HealthTracker()
+        self._balancer = balancer
+        self._retry = retry or RetryPolicies()
+        self._keyspace_set = None
+        self._bound = {}
+        
+        self._lock = threading.Condition()
+        self._idle = [] # LIFO, so the least recently used connections sit at the bottom
+        self._size = 0  # open connections, idle and checked out
+
+    def set_keyspace(self, keyspace):
+        # connections pick up the keyspace when they are checked out
+        self._keyspace_set = keyspace
+        with self.connection():
+            pass
+
+    def size(self):
+        return self._size
+
+    def idle(self):
+        return len(self._idle)
+
+# ----- Token aware routing -----
+
+    def set_servers(self, servers):
+        queue = Queue()
+        for i in xrange(len(servers)):
+            queue.put(i)
+        self._servers, self._queue = list(servers), queue
+
+    def split_keys(self, keys):
+        """Group keys by the first replica that isn't down."""
+        if self._ring is None:
+            return [(None, keys)]
+        
+        byserver = OrderedDict()
+        for key in keys:
+            byserver.setdefault(self._pick_replica(self._ring.replicas(key)), []).append(key)
+        return byserver.items()
+
+    def hedge_servers(self, server, keys):
+        candidates = [candidate for candidate in self._round_robin_servers() if self._health.usable(candidate)]
+        if server is None:
+            if not candidates:
+                return None, None
+            server = candidates.pop(0)
+        if self._ring is not None:
+            # prefer a replica that holds all the keys
+            shared = None
+            for key in keys:
+                replicas = set(self._ring.replicas(key))
+                shared = replicas if shared is None else shared & replicas
+            candidates = [c for c in candidates if c in shared] + [c for c in candidates if c not in shared]
+        candidates = [c for c in candidates if c != server]
+        return server, (candidates[0] if candidates else None)
+
+    def _pick_replica(self, replicas):
+        for server in replicas:
+            if self._health.usable(server):
+                return server
+        return None # every replica is down, let any server coordinate
+
+    def on(self, server):
+        if server is None:
+            return self
+        bound = self._bound.get(server)
+        if bound is None:
+            bound = self._bound[server] = BoundConnection(self, server)
+        return bound
+
+# ----- Checkout and Checkin -----
+
+    def checkout(self, server=None):
+        if self._pool_timeout is not None:
+            deadline = time.time() + self._pool_timeout
+        conn = None
+        with self._lock:
+            while True:
+                self._reap_idle()
+                conn = self._pop_idle(server)
+                if conn:
+                    break
+                if self._size < self._pool_size + self._max_overflow:
+                    self._size += 1
+                    break
+                if server and self._idle:
+                    # make room for a connection to the server we want
+                    self._idle.pop(0).close()
+                    self._size -= 1
+                    continue
+                if self._pool_timeout is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout('No connection available after %s seconds.' % (self._pool_timeout,))
+                    self._lock.wait(remaining)
+        
+        try:
+            if conn is None:
+                conn = self._open(server)
+            if self._keyspace_set and conn.keyspace != self._keyspace_set:
+                conn.client.set_keyspace(self._keyspace_set)
+                conn.keyspace = self._keyspace_set
+        except:
+            self.dispose(conn)
+            raise
+        return conn
+
+    def checkin(self, conn):
+        conn.requests += 1
+        conn.last_used = time.time()
+        with self._lock:
+            if (self._recycle and conn.requests >= self._recycle) or \
+                    len(self._idle) >= self._pool_size:
+                self._size -= 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._lock.notify()
+
+    def dispose(self, conn):
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+        if conn is not None:
+            conn.close()
+
+    def dispose_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._lock.notify_all()
+        for conn in idle:
+            conn.close()
+
+    @contextmanager
+    def connection(self, server=None):
+        conn = self.checkout(server)
+        try:
+            yield conn
+        except TRANSPORT_ERRORS, exc:
+            self.dispose(conn)
+            if went_stale(exc, conn.requests > 0):
+                self._close_idle(conn.server)
+            else:
+                self._server_failed(conn.server)
+            raise
+        except:
+            self.checkin(conn)
+            raise
+        else:
+            self.checkin(conn)
+
+    @contextmanager
+    def _raw_client(self, server=None):
+        with self.connection(server) as conn:
+            yield conn.client
+
+# ----- Calls -----
+
+    def _attempt(self, attr, args, kwargs, server=None, timeout=None):
+        conn = self.checkout(server)
+        reconnected = False
+        while True:
+            try:
+                with call_timeout(conn.client, timeout, self._timeout):
+                    result = timed_call(self._balancer, conn.server, conn.client, attr, args, kwargs)
+            except TRANSPORT_ERRORS, exc:
+                unhandled_exception_handler()
+                self.dispose(conn)
+                if reconnected or not went_stale(exc, conn.requests > 0):
+                    # Connection error, the next attempt goes to a server that isn't down
+                    self._server_failed(conn.server)
+                    raise
+                # the idle connections to its server went stale along with it
+                self._close_idle(conn.server)
+                reconnected = True
+                conn = self.checkout(conn.server)
+                continue
+            except:
+                self.checkin(conn)
+                raise
+            self._health.mark_up(conn.server)
+            self.checkin(conn)
+            return result
+
+    def _server_failed(self, server):
+        self._health.mark_down(server)
+        if self._health.usable(server):
+            return
+        # idle connections to a server that is down are most likely dead, too
+        self._close_idle(server)
+
+    def _close_idle(self, server):
+        with self._lock:
+            dead = [conn for conn in self._idle if conn.server == server]
+            self._idle = [conn for conn in self._idle if conn.server != server]
+            self._size -= len(dead)
+            self._lock.notify_all()
+        for conn in dead:
+            conn.close()
+
+    def _round_robin_servers(self):
+        servers = self._servers
+        if self._balancer:
+            return self._balancer.order(servers)
+        i = self._queue.get()
+        self._queue.put(i)
+        return servers[i:]+servers[:i]
+
+    def _open(self, server=None):
+        if server and self._health.attempt(server):
+            try:
+                return PooledConnection(server, self._framed_transport, self._timeout)
+            except TRANSPORT_ERRORS, exc:
+                self._health.mark_down(server) # fall back to any server
+        return self._find_server()
+
+    def _find_server(self):
+        for server in self._health.candidates(self._round_robin_servers()):
+            try:
+                return PooledConnection(server, self._framed_transport, self._timeout)
+            except TRANSPORT_ERRORS, exc:
+                self._health.mark_down(server)
+                continue
+        raise NoServerAvailable()
+
+    def _pop_idle(self, server=None):
+        # called with self._lock held
+        if not self._idle:
+            return None
+        if server is None and self._balancer:
+            server = self._balancer.order(set(conn.server for conn in self._idle))[0]
+        elif server is None or not self._health.usable(server):
+            return self._idle.pop()
+        for i in xrange(len(self._idle)-1, -1, -1):
+            if self._idle[i].server == server:
+                return self._idle.pop(i)
+        return None
+
+    def _reap_idle(self):
+        # called with self._lock held
+        if not self._idle_timeout:
+            return
+        cutoff = time.time() - self._idle_timeout
+        while self._idle and self._idle[0].last_used < cutoff:
+            conn = self._idle.pop(0)
+            self._size -= 1
+            conn.close()
@@ -5,3 +5,8 @@ class TragedyException(Exception):
 class NoServerAvailable(TragedyException):
     pass
 
+class PoolTimeout(TragedyException):
+    pass
+
+class FutureTimeout(TragedyException):
+    pass
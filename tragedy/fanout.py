@@ -0,0 +1,159 @@
+import threading
+import uuid
+from collections import deque
+
+from cassandra.ttypes import (Clock,
+                              Deletion,
+                              Mutation,
+                              SlicePredicate,
+                             )
+
+from .rows import RowKey
+from .models import Model
+from .columns import ByteField
+from .futures import (Executor,
+                      default_executor,
+                     )
+
+class MemoryCheckpoints(object):
+    """Keeps fan-out checkpoints in a dict, so they only survive as long as the
+       process. Good for tests and for retrying a job in the same process,
+       use ModelCheckpoints for anything else."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checkpoints = {}
+
+    def get(self, job_id):
+        with self._lock:
+            return self._checkpoints.get(job_id)
+
+    def set(self, job_id, checkpoint):
+        with self._lock:
+            self._checkpoints[job_id] = checkpoint
+
+    def delete(self, job_id):
+        with self._lock:
+            self._checkpoints.pop(job_id, None)
+
+class ModelCheckpoints(object):
+    """Keeps fan-out checkpoints in Cassandra, in the column family
+       column_family of keyspace, so a job that was interrupted by a restart
+       resumes where it stopped. Use it for everything run through
+       FanOut.submit(). Like any Model, create it before keyspace.connect()
+       if you want auto_create_models to create its column family."""
+    def __init__(self, keyspace, column_family='FanOutCheckpoints', consistency_level=None):
+        class FanOutCheckpoint(Model):
+            # the column key the job appends with, and the last source column key it's done with
+            _column_family = column_family
+            _keyspace = keyspace
+            _auto_timestamp = False
+            job_id = RowKey()
+            column_key = ByteField()
+            after = ByteField(mandatory=False)
+        self.model = FanOutCheckpoint
+        self.consistency_level = consistency_level
+
+    def get(self, job_id):
+        columns = dict(self.model.get_slice(job_id, column_names=['column_key', 'after'],
+                                            consistency_level=self.consistency_level))
+        if 'column_key' not in columns:
+            return None
+        return columns['column_key'], columns.get('after')
+
+    def set(self, job_id, checkpoint):
+        column_key, after = checkpoint
+        row = self.model(job_id=job_id, column_key=column_key)
+        if after is not None:
+            row['after'] = after
+        row.save(write_consistency_level=self.consistency_level)
+
+    def delete(self, job_id):
+        deletion = Deletion(clock=Clock(timestamp=self.model._timestamp_func()),
+                            predicate=SlicePredicate(column_names=['column_key', 'after']))
+        self.model.batch_mutate({job_id: {self.model._column_family: [Mutation(deletion=deletion)]}},
+                                consistency_level=self.consistency_level)
+
+class FanOut(object):
+    """Appends a target to the rows of index_class named by every value of the
+       source Index row, e.g. a tweet to the timelines of all followers:
+
+           FanOut(Followers(author), Timeline).run(tweet, job_id=tweet.row_key)
+
+       The source is read page_size columns at a time, and each page becomes
+       one append_to_many, with up to workers of them running at once. After
+       each page (and every page before it) is done, the checkpoint for job_id
+       is updated, so running the job again resumes after the last finished
+       page. All pages use the same column key, so pages that get written
+       twice don't leave duplicates. The checkpoints are kept in memory unless
+       you pass ModelCheckpoints, which you should for jobs that have to
+       survive a restart."""
+    def __init__(self, source, index_class, page_size=1000, workers=4, checkpoints=None):
+        self.source = source
+        self.index_class = index_class
+        self.page_size = page_size
+        self.workers = workers
+        self.checkpoints = checkpoints if checkpoints is not None else MemoryCheckpoints()
+
+    def submit(self, target, job_id=None, executor=None):
+        """Run the fan-out in the background. Returns a Future of run()'s result.
+           Jobs like that outlive requests, so give them ModelCheckpoints."""
+        return (executor or default_executor()).submit(self.run, target, job_id)
+
+    def pages(self, after=None):
+        """The pages of the source, starting after the column key after."""
+        for page in self.source.iter_pages(self.page_size, reverse=False, start=after or ''):
+            if after and page[0][0] == after:
+                page = page[1:]
+            after = None
+            if page:
+                yield page
+
+    def run(self, target, job_id=None):
+        """Fan target out and return the number of rows it was appended to."""
+        checkpoint = self.checkpoints.get(job_id) if job_id else None
+        column_key, after = checkpoint or (uuid.uuid1().bytes, None)
+        if job_id and not checkpoint:
+            # before anything is written, so a rerun reuses the column key whatever happens
+            self.checkpoints.set(job_id, (column_key, None))
+
+        def append(page):
+            row_keys = [value for page_column_key, value in page if value]
+            self.index_class.append_to_many(row_keys, target, column_key=column_key)
+            return len(row_keys)
+
+        def finished(page, appended):
+            if job_id:
+                self.checkpoints.set(job_id, (column_key, page[-1][0]))
+            return appended
+
+        appended = 0
+        if self.workers <= 1 or not self.index_class.getclient().thread_safe:
+            for page in self.pages(after):
+                appended += finished(page, append(page))
+        else:
+            appended = self._run_parallel(append, finished, after)
+
+        if job_id:
+            self.checkpoints.delete(job_id)
+        return appended
+
+    def _run_parallel(self, append, finished, after):
+        # Waiting for the oldest page first keeps the checkpoint contiguous:
+        # it never moves past a page that isn't done yet.
+        executor = Executor(self.workers, name='tragedy-fanout')
+        inflight = deque()
+        appended = 0
+        try:
+            for page in self.pages(after):
+                if len(inflight) >= self.workers:
+                    done_page, future = inflight.popleft()
+                    appended += finished(done_page, future.result())
+                inflight.append((page, executor.submit(append, page)))
+            while inflight:
+                done_page, future = inflight.popleft()
+                appended += finished(done_page, future.result())
+        finally:
+            for page, future in inflight:
+                future.wait() # don't leave writes running behind the caller's back
+            executor.shutdown(wait=False)
+        return appended
@@ -0,0 +1,204 @@
+import sys
+import threading
+from Queue import Queue, Empty, Full
+
+from .exceptions import FutureTimeout
+
+class Future(object):
+    """The result of a call running on an Executor."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.isSet()
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise FutureTimeout('Call did not finish within %s seconds.' % (timeout,))
+        return self._exc_info[1] if self._exc_info else None
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise FutureTimeout('Call did not finish within %s seconds.' % (timeout,))
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+class Executor(object):
+    """A fixed number of daemon threads working off a queue of calls."""
+    def __init__(self, workers=8, name='tragedy'):
+        self.workers = workers
+        self.name = name
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def submit(self, func, *args, **kwargs):
+        if len(self._threads) < self.workers:
+            self._start_worker()
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def map(self, func, iterable):
+        return [self.submit(func, item) for item in iterable]
+
+    def in_worker(self):
+        """True if we're running on one of our own workers. Waiting for other
+           calls from in here can deadlock once all workers wait."""
+        return getattr(self._local, 'worker', False)
+
+    def _start_worker(self):
+        with self._lock:
+            if len(self._threads) >= self.workers:
+                return
+            thread = threading.Thread(target=self._work, name='%s-%s' % (self.name, len(self._threads)))
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    def _work(self):
+        self._local.worker = True
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            future, func, args, kwargs = job
+            try:
+                future.set_result(func(*args, **kwargs))
+            except:
+                future.set_exception(sys.exc_info())
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+_default_executor = None
+_default_lock = threading.Lock()
+
+def default_executor():
+    global _default_executor
+    if _default_executor is None:
+        with _default_lock:
+            if _default_executor is None:
+                _default_executor = Executor()
+    return _default_executor
+
+def set_default_executor(executor):
+    global _default_executor
+    _default_executor = executor
+
+def wait_first(futures, timeout=None):
+    """Return the first of futures to finish, or None after timeout seconds."""
+    finished = Queue()
+    for future in futures:
+        future.add_done_callback(finished.put)
+    try:
+        return finished.get(timeout=timeout)
+    except Empty:
+        return None
+
+def background(iterable, depth=1, name='tragedy-background'):
+    """Iterate over iterable on a thread of its own, staying up to depth items
+       ahead of the consumer. Exceptions are raised in the consumer."""
+    queue = Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.isSet():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except:
+            put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=produce, name=name)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            more, item = queue.get()
+            if more:
+                yield item
+            elif more is None:
+                raise item[0], item[1], item[2]
+            else:
+                break
+    finally:
+        stopped.set() # the consumer is done, stop producing
+
+class SingleFlight(object):
+    """Lets concurrent callers that want the same keys share one fetch: the
+       first to claim a key fetches it, everybody else waits for its Future."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {} # key -> Future
+
+    def claim(self, keys):
+        """Returns the keys that are ours to fetch, and a dict key -> Future for
+           the keys somebody else is fetching already."""
+        ours, theirs = [], {}
+        with self._lock:
+            for key in keys:
+                if key in self._inflight:
+                    theirs[key] = self._inflight[key]
+                elif key not in ours:
+                    self._inflight[key] = Future()
+                    ours.append(key)
+        return ours, theirs
+
+    def finish(self, keys, results=None, exc_info=None):
+        """Hand results[key] (or exc_info) to everyone waiting for our keys."""
+        with self._lock:
+            futures = [self._inflight.pop(key) for key in keys]
+        for key, future in zip(keys, futures):
+            if exc_info:
+                future.set_exception(exc_info)
+            else:
+                future.set_result(results.get(key))
@@ -0,0 +1,100 @@
+import threading
+import time
+
+UP = 'up'
+DOWN = 'down'
+HALF_OPEN = 'half-open'
+
+class ServerHealth(object):
+    def __init__(self, server):
+        self.server = server
+        self.state = UP
+        self.failures = 0
+        self.retry_at = 0
+        self.down_since = None
+
+    def __repr__(self):
+        return '<ServerHealth %s: %s (%s failures)>' % (self.server, self.state, self.failures)
+
+class HealthTracker(object):
+    """Keeps track of servers that failed us. A failed server is marked down and
+       left alone for an exponentially growing backoff. Once that has passed,
+       exactly one request may probe it (half-open): success brings it back up,
+       failure marks it down again for longer. threshold is the number of
+       failures in a row it takes to mark a server down. If every server is
+       down, the one that has been down the longest is tried anyway."""
+    def __init__(self, threshold=1, backoff=1.0, max_backoff=60.0, probe_timeout=10.0):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    def mark_up(self, server):
+        if server not in self._servers: # everything is up until it failed
+            return
+        with self._lock:
+            self._servers.pop(server, None)
+
+    def mark_down(self, server):
+        if server is None:
+            return
+        with self._lock:
+            health = self._servers.get(server)
+            if health is None:
+                health = self._servers[server] = ServerHealth(server)
+            health.failures += 1
+            if health.failures < self.threshold:
+                return
+            if health.down_since is None:
+                health.down_since = time.time()
+            health.state = DOWN
+            health.retry_at = time.time() + min(self.max_backoff,
+                                                self.backoff * 2 ** (health.failures - self.threshold))
+
+    def usable(self, server):
+        """True if server is up or due for a probe. Doesn't reserve the probe."""
+        health = self._servers.get(server)
+        return health is None or health.state == UP or time.time() >= health.retry_at
+
+    def attempt(self, server):
+        """True if we may talk to server now. Reserves the probe of a server
+           that is due for one, so concurrent requests leave it alone."""
+        if server not in self._servers:
+            return True
+        with self._lock:
+            health = self._servers.get(server)
+            if health is None or health.state == UP:
+                return True
+            now = time.time()
+            if now < health.retry_at:
+                return False
+            health.state = HALF_OPEN
+            health.retry_at = now + self.probe_timeout
+            return True
+
+    def candidates(self, servers):
+        """Lazily yield the servers out of servers we may talk to now. If
+           that's none of them, yield the one that has been down the longest:
+           trying it beats giving up without trying."""
+        servers = list(servers)
+        found = False
+        for server in servers:
+            if self.attempt(server):
+                found = True
+                yield server
+        if not found and servers:
+            yield self.longest_down(servers)
+
+    def longest_down(self, servers):
+        with self._lock:
+            return min(servers, key=lambda server: getattr(self._servers.get(server), 'down_since', None) or 0)
+
+    def state(self, server):
+        health = self._servers.get(server)
+        return health.state if health else UP
+
+    def down(self):
+        with self._lock:
+            return [h for h in self._servers.values() if h.state != UP]
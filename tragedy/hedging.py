@@ -0,0 +1,107 @@
+import sys
+import threading
+import time
+from collections import deque
+
+from .futures import (Executor,
+                      Future,
+                      wait_first,
+                     )
+
+class LatencyWindow(object):
+    """The most recent latencies, to compute percentiles from."""
+    def __init__(self, size=1000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=size)
+
+    def add(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def percentile(self, percent):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100.0))]
+
+def _run_in_thread(func):
+    """Run func on a thread of its own and return a Future of its result.
+       Unlike an Executor, this never queues, so the wait can't be mistaken
+       for a slow server."""
+    future = Future()
+    def run():
+        try:
+            future.set_result(func())
+        except:
+            future.set_exception(sys.exc_info())
+    thread = threading.Thread(target=run, name='tragedy-hedge-primary')
+    thread.daemon = True
+    thread.start()
+    return future
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+def hedge_executor():
+    """The Executor that runs the second reads of all Hedgers."""
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = Executor(workers=16, name='tragedy-hedge')
+    return _hedge_executor
+
+class Hedger(object):
+    """Runs a read, and if it takes longer than percentile of the recent reads,
+       sends the same read to a second server. Whichever answers first wins.
+
+       The first read runs on a thread of its own, so its latency is the
+       server's and not that of a queue. Only second reads go through an
+       Executor, hedge_executor() unless one is given, which is never used
+       for anything else, so hedging works from any thread, Executor workers
+       (load_multi chunks, aload*, ...) included."""
+    def __init__(self, percentile=95, window=1000, min_samples=20, executor=None):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = LatencyWindow(window)
+        self._executor = executor
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'fired': 0, 'won': 0}
+
+    @property
+    def executor(self):
+        return self._executor or hedge_executor()
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _timed(self, func):
+        start = time.time()
+        result = func()
+        self.window.add(time.time() - start)
+        return result
+
+    def call(self, primary, secondary=None):
+        self._count('requests')
+        if secondary is None or len(self.window) < self.min_samples:
+            return self._timed(primary)
+
+        threshold = self.window.percentile(self.percentile)
+        first = _run_in_thread(lambda: self._timed(primary))
+        if first.wait(threshold):
+            return first.result()
+
+        self._count('fired')
+        second = self.executor.submit(secondary)
+        winner = wait_first([first, second])
+        if winner.exception() is not None:
+            # the loser might still come through
+            winner = second if winner is first else first
+        if winner is second:
+            self._count('won')
+        return winner.result()
@@ -1,3 +1,5 @@
+import threading
+
 from cassandra.ttypes import (KsDef,)
 from .datastructures import (OrderedDict,)
 from .util import (CASPATHSEP,
@@ -5,6 +7,9 @@ from .util import (CASPATHSEP,
                    popmulti,
                   )
 from . import connection
+from .ring import RingRefresher
+from .batch import Batch
+from .writebehind import WriteBehind
 
 cmcache = CrossModelCache()
 
@@ -14,6 +19,12 @@ possible_validate_args = (
                           ('auto_drop_columnfamilies', False),
                          )
 
+connection_methods = {
+                      'single': connection.connect,
+                      'thread_local': connection.connect_thread_local,
+                      'pool': connection.connect_pool,
+                     }
+
 class InventoryType(type):
     """This keeps inventory of the models created, and prepares the
        limited amount of metaclass magic that we do. keep this small!"""
@@ -50,6 +61,9 @@ class Keyspace(object):
         self.name = name
         self.cluster = cluster
         self._client = None
+        self._ring_refresher = None
+        self._writer = None
+        self._writer_lock = threading.Lock()
         self._first_iteration_in_this_cycle = False
         cluster.registerKeyspace(self.name, self)
         
@@ -60,7 +74,13 @@ class Keyspace(object):
 
     def connect(self, *args, **kwargs):
         newkwargs = popmulti(kwargs, *possible_validate_args )
-        self._client = connection.connect(*args, **kwargs)
+        method = kwargs.pop('method', 'single')
+        token_aware = kwargs.pop('token_aware', False)
+        discover = kwargs.pop('discover', False)
+        refresh_interval = kwargs.pop('refresh_interval', 60)
+        assert method in connection_methods, 'Unknown connection method %s' % (method,)
+        assert method == 'pool' or not token_aware, 'Token aware routing needs a connection pool.'
+        self._client = connection_methods[method](*args, **kwargs)
         
         for model in self.models.values():
             model._init_stage_two()
@@ -70,11 +90,50 @@ class Keyspace(object):
             
         if not self._client._keyspace_set:
             self._client.set_keyspace(self.name)
+        
+        if self._ring_refresher:
+            self._ring_refresher.stop()
+            self._ring_refresher = None
+        
+        if token_aware or discover:
+            self._client.refresh_ring(self.name, route=token_aware, discover=discover)
+            if refresh_interval:
+                # the refresher calls describe_ring from its own thread, on our connection.
+                assert self._client.thread_safe, 'Refreshing the ring needs a thread safe connection (pool or thread_local), or refresh_interval=0.'
+                self._ring_refresher = RingRefresher(self._client, self.name, refresh_interval, 
+                                                     route=token_aware, discover=discover)
+                self._ring_refresher.start()
 
     def getclient(self):
         assert self._client, "Keyspace doesn't have a connection."
         return self._client
 
+    def batch(self, max_mutations=None, consistency_level=None):
+        """Collect all writes to this keyspace in this thread and send them
+           together when the block ends:
+
+               with keyspace.batch():
+                   user.save()
+                   tweet.save()
+
+           max_mutations bounds the size of each batch_mutate, and
+           consistency_level overrides the one of every write in the block."""
+        return Batch(self, max_mutations=max_mutations, consistency_level=consistency_level)
+
+    def writer(self, **kwargs):
+        """The WriteBehind that sends the writes of save(async=True) and of
+           models with _write_behind. kwargs configure it, which only works
+           before it exists: call writer(...) once after connect(), before
+           anything is saved with write-behind. Needs a thread safe connection
+           (pool or thread_local). Call writer().join() before shutting down,
+           or queued writes are lost."""
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = WriteBehind(self, **kwargs)
+            else:
+                assert not kwargs, 'The writer of %s is configured already, configure it before the first write-behind save.' % (self,)
+            return self._writer
+
     def path(self):
         return u'%s%s%s' % (self.cluster.name, CASPATHSEP, self.name)
 
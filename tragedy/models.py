@@ -1,3 +1,8 @@
+from cassandra.ttypes import (Clock,
+                              Column,
+                              ColumnOrSuperColumn,
+                              Mutation,
+                             )
 from .rows import DictRow, RowKey
 from .columns import (ByteField, 
                       TimeField,
@@ -7,7 +12,14 @@ from .columns import (ByteField,
                       BaseField,
                      )
 import uuid
+import base64
+import itertools
+from datetime import datetime
+from . import timestamp
 from .exceptions import TragedyException
+from .futures import background
+from .cache import ExpiringCache
+from .batch import current_batch
 
 from .hierarchy import cmcache
 
@@ -108,6 +120,13 @@ class Index(DictRow):
     # _default_field = ByteField()
     _order_by = 'TimeUUIDType'
     _ordered = True
+    
+    # Remember count() results for this many seconds (0 doesn't), for at most this many rows.
+    _count_cache_ttl = 0
+    _count_cache_size = 10000
+    
+    # append_to_many writes to this many rows per batch_mutate.
+    _append_chunk_size = 500
 
     @classmethod
     def _init_class(cls, *args, **kwargs):
@@ -115,20 +134,102 @@ class Index(DictRow):
         if hasattr(cls, 'targetmodel'):
             cls._default_field = cls.targetmodel
             del cls.targetmodel
+        cls._count_cache = ExpiringCache(cls._count_cache_size, cls._count_cache_ttl) if cls._count_cache_ttl else None
+        cls._members = None
+        if getattr(cls._default_field, 'unique', False):
+            class IndexMembersImplementation(IndexMembers):
+                _column_family = '%s_Members' % (cls._column_family,)
+                _keyspace = cls._keyspace
+            cls._members = IndexMembersImplementation
+
+    def count(self, consistency_level=None, **kwargs):
+        """The number of columns in this row, counted by the server."""
+        assert self.row_key, 'Need a row_key to count.'
+        return self.count_many([self.row_key], consistency_level=consistency_level, **kwargs)[self.row_key]
+
+    @classmethod
+    def count_many(cls, keys, consistency_level=None, **kwargs):
+        """A dict of row_key -> number of columns, for all keys at once. Only
+           the counts go over the wire, not the columns. Counts of whole rows
+           are cached for _count_cache_ttl seconds, or until we save the row."""
+        cache = cls._count_cache if not kwargs else None
+        token = cache.token() if cache is not None else None
+        counts = {}
+        missing = []
+        for row_key in keys:
+            count = cache.get(row_key) if cache is not None else None
+            if count is None:
+                missing.append(row_key)
+            else:
+                counts[row_key] = count
+        if not missing:
+            return counts
+        
+        kwargs.setdefault('count', 2**31 - 1) # the predicate limits the count
+        predicate = cls.get_slice_predicate(**kwargs)
+        client = cls.getclient()
+        for server, server_keys in client.split_keys(missing):
+            if len(server_keys) == 1:
+                fetched = {server_keys[0]: client.on(server).get_count(key=server_keys[0],
+                                                                      column_parent=cls.column_parent(),
+                                                                      predicate=predicate,
+                                                                      consistency_level=cls._rcl(consistency_level),
+                                                                     )}
+            else:
+                fetched = client.on(server).multiget_count(keyspace=str(cls._keyspace),
+                                                           keys=server_keys,
+                                                           column_parent=cls.column_parent(),
+                                                           predicate=predicate,
+                                                           consistency_level=cls._rcl(consistency_level),
+                                                          )
+            for row_key in server_keys:
+                counts[row_key] = (fetched or {}).get(row_key, 0)
+                if cache is not None:
+                    cache.set(row_key, counts[row_key], token)
+        return counts
+
+    @classmethod
+    def _invalidate(cls, row_key):
+        super(Index, cls)._invalidate(row_key)
+        if cls._count_cache is not None:
+            cls._count_cache.drop(row_key)
+
+    def _mutation_map(self, save_row_key):
+        mumap = super(Index, self)._mutation_map(save_row_key)
+        if self._members is not None: # same row key, so it goes out in the same batch_mutate
+            mutations = mumap[save_row_key][self._column_family]
+            mumap[save_row_key][self._members._column_family] = self._members.mutations_for(mutations)
+        return mumap
+
+    def rebuild_members(self, page_size=1000):
+        """Write the _members row for everything this row points to. Only needed
+           for unique indexes that were written before there were _members."""
+        assert self._members is not None, '%s is not unique.' % (self._column_family,)
+        for page in self.iter_pages(page_size):
+            mutations = [Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(name=value, value=column_key,
+                                  clock=Clock(timestamp=self._timestamp_func())))) for column_key, value in page]
+            self.batch_mutate({self.row_key: {self._members._column_family: mutations}})
 
     def is_unique(self, target):
+        """True if we don't point to target yet. For unique indexes that's one
+           column read from the _members row, instead of loading the whole row."""
         if self._order_by != 'TimeUUIDType':
             return True
+        
+        mytarget = self._default_field.value_to_internal(target)
+        if mytarget in self.itervalues(): # appended, but maybe not saved yet
+            return False
+        if self._members is not None:
+            return not self._members.contains(self.row_key, mytarget)
             
         MAXCOUNT = 20000000
         self.load(count=MAXCOUNT) # XXX: we will blow up here at some point
                                   # i don't know where the real limit is yet.
         assert len(self.column_values) < MAXCOUNT - 1, 'Too many keys to enforce sorted uniqueness!'
-        mytarget = self._default_field.value_to_internal(target)
         if mytarget in self.itervalues():
             return False
         return True
-        
+
     def get_next_column_key(self):
         assert self._order_by == 'TimeUUIDType', 'Append makes no sense for sort order %s' % (self._order_by,)
         return uuid.uuid1().bytes
@@ -148,24 +249,216 @@ class Index(DictRow):
         self._update( [(column_key, target)] )
         return self
 
+    @classmethod
+    def append_to_many(cls, row_keys, target, chunk_size=None, consistency_level=None, column_key=None):
+        """Append target to every row in row_keys, e.g. a tweet to the timelines
+           of all followers. All rows get the same column, and it's written with
+           one batch_mutate per chunk_size rows instead of a save per row. Rows
+           of a unique index that already point to target are left alone, with
+           one read per chunk. Passing the column_key of an earlier call makes
+           repeating it harmless. Returns the column key."""
+        assert cls._order_by == 'TimeUUIDType', 'Append makes no sense for sort order %s' % (cls._order_by,)
+        assert isinstance(target, cls._default_field.foreign_class), "Trying to store ForeignKey of wrong type!"
+        target = cls._default_field.value_to_internal(target)
+        column_key = column_key or uuid.uuid1().bytes
+        chunk_size = chunk_size or cls._append_chunk_size
+        
+        row_keys = list(row_keys)
+        for i in xrange(0, len(row_keys), chunk_size):
+            chunk = row_keys[i:i+chunk_size]
+            if cls._members is not None:
+                chunk = cls._members.missing(chunk, target, consistency_level)
+            if not chunk:
+                continue
+            
+            column = Column(name=column_key, value=target, clock=Clock(timestamp=cls._timestamp_func()))
+            mutations = {cls._column_family: [Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=column))]}
+            if cls._members is not None:
+                mutations[cls._members._column_family] = cls._members.mutations_for(mutations[cls._column_family])
+            cls.batch_mutate(dict((row_key, mutations) for row_key in chunk), consistency_level=consistency_level)
+        return column_key
+
+    def iter_pages(self, page_size=1000, reverse=True, start='', finish='', **kwargs):
+        """Lazily yield the whole row as lists of up to page_size (column_key, value)
+           pairs, one request per page. Unlike load(), this doesn't stop at 10000
+           columns and never holds more than one page in memory."""
+        assert self.row_key, 'Need a row_key to iterate over.'
+        skip = None # every page starts with the last column of the one before
+        while True:
+            count = page_size + 1 if skip is not None else page_size
+            columns = self.get_slice(self.row_key, start=start, finish=finish, 
+                                     reverse=reverse, count=count, **kwargs)
+            page = [(column_key, value) for column_key, value in columns if column_key != skip]
+            if page:
+                yield page
+            if len(columns) < count:
+                break
+            start = skip = columns[-1][0]
+
+    def iter_columns(self, page_size=1000, reverse=True, **kwargs):
+        """Lazily yield the (column_key, value) pairs of the whole row."""
+        for page in self.iter_pages(page_size, reverse, **kwargs):
+            for column_key, value in page:
+                yield column_key, value
+
+    def page(self, cursor=None, limit=20, reverse=True, resolve=False, prefetch=None, **kwargs):
+        """One page of up to limit items and the cursor for the next page, or
+           None if this was the last one. Items are (column_key, value) pairs,
+           or the rows they point to with resolve. The cursor is an opaque
+           string holding the direction and the last column key, so the next
+           page is a single get_slice and no state is kept in between.
+           prefetch is passed on to load_multi when resolving."""
+        start = ''
+        if cursor:
+            reverse, start = self.decode_cursor(cursor)
+        count = limit + 2 if start else limit + 1 # one more, to see if there's another page
+        columns = self.get_slice(self.row_key, start=start, reverse=reverse, count=count, **kwargs)
+        if start and columns and columns[0][0] == start:
+            columns = columns[1:]
+        
+        items = columns[:limit]
+        next_cursor = None
+        if len(columns) > limit:
+            next_cursor = self.encode_cursor(items[-1][0], reverse)
+        
+        if resolve and items:
+            items = list(self._default_field.foreign_class.load_multi(keys=[value for column_key, value in items],
+                                                                      prefetch=prefetch))
+        return items, next_cursor
+
+    @staticmethod
+    def encode_cursor(column_key, reverse):
+        return base64.urlsafe_b64encode(('r' if reverse else 'f') + column_key)
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            decoded = base64.urlsafe_b64decode(str(cursor))
+        except (TypeError, UnicodeEncodeError):
+            raise TragedyException('Invalid cursor %r' % (cursor,))
+        if len(decoded) < 2 or decoded[0] not in 'rf':
+            raise TragedyException('Invalid cursor %r' % (cursor,))
+        return decoded[0] == 'r', decoded[1:]
+
+    def iter_resolved(self, page_size=1000, reverse=True, read_ahead=1, prefetch=None, **kwargs):
+        """Lazily yield the rows the whole index points to. With read_ahead, 
+           one thread fetches the next pages and another resolves them while
+           we're busy with the current one, each staying up to read_ahead pages
+           ahead."""
+        foreign_class = self._default_field.foreign_class
+        resolve = lambda page: list(foreign_class.load_multi(keys=[value for column_key, value in page], prefetch=prefetch))
+        
+        pages = self.iter_pages(page_size, reverse, **kwargs)
+        if read_ahead and self.getclient().thread_safe:
+            pages = background(pages, read_ahead, name='%s-fetch' % (self._column_family,))
+            resolved = background(itertools.imap(resolve, pages), read_ahead,
+                                  name='%s-resolve' % (self._column_family,))
+        else:
+            resolved = itertools.imap(resolve, pages)
+        
+        for rows in resolved:
+            for row in rows:
+                yield row
+
     def loadIterItems(self):
         return itertools.izip(self.iterkeys(), self.loadIterValues())
 
-    def loadIterValues(self):
+    def loadIterValues(self, prefetch=None):
         if self.values():
-            return self._default_field.foreign_class.load_multi(keys=self.values()) #orderdata=self.keys())
+            return self._default_field.foreign_class.load_multi(keys=self.values(), prefetch=prefetch) #orderdata=self.keys())
         return []
 
-    def resolve(self):
-        return self.loadIterValues()
+    def resolve(self, prefetch=None):
+        """The rows we point to. prefetch names their ForeignKeys to load as
+           well, e.g. resolve(prefetch=['author']) for a list of tweets."""
+        return self.loadIterValues(prefetch)
+
+    def aresolve(self, prefetch=None):
+        """Like resolve, but returns a Future of the list of resolved rows."""
+        return self._submit(lambda: list(self.resolve(prefetch)))
 
     def __iter__(self):
         for row_key in self.itervalues():
             yield self._default_field.foreign_class(row_key=row_key)
 
+class IndexMembers(DictRow):
+    """The reverse of a unique Index: for each index row, a row of the same key
+       with one column per row key the index points to, holding the column key
+       it is stored under. Written together with the index."""
+    __abstract__ = True
+    index_key = RowKey()
+    _order_by = 'BytesType'
+
+    @classmethod
+    def pending(cls, row_key, target_key):
+        """True if the current batch or the keyspace's writer is about to
+           write target_key to row_key."""
+        batch = current_batch(cls._keyspace)
+        if batch is not None and batch.has_column(cls._column_family, row_key, target_key):
+            return True
+        writer = cls._keyspace._writer
+        return writer is not None and writer.has_column(cls._column_family, row_key, target_key)
+
+    @classmethod
+    def contains(cls, row_key, target_key, consistency_level=None):
+        if cls.pending(row_key, target_key):
+            return True
+        # a slice, not a get: "not found" is the common answer here, and shouldn't be an exception.
+        return bool(cls.get_slice(row_key, column_names=[target_key], consistency_level=consistency_level))
+
+    @classmethod
+    def missing(cls, row_keys, target_key, consistency_level=None):
+        """The row_keys whose index rows don't point to target_key, with one read."""
+        found = set(row_key for row_key, columns in cls.multiget_slice(keys=row_keys, column_names=[target_key],
+                                                                       consistency_level=consistency_level) if columns)
+        return [row_key for row_key in row_keys if row_key not in found and not cls.pending(row_key, target_key)]
+
+    @staticmethod
+    def mutations_for(index_mutations):
+        """Turn the mutations of index columns into ours, keeping their clocks."""
+        mutations = []
+        for mutation in index_mutations:
+            column = mutation.column_or_supercolumn.column
+            if not column.value:
+                continue
+            member = Column(name=column.value, value=column.name, clock=column.clock)
+            mutations.append(Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=member)))
+        return mutations
+
 class TimeOrderedIndex(Index):
     __abstract__ = True
     _order_by = 'TimeUUIDType'
 
+    @staticmethod
+    def time_bound(value, lowest=True):
+        """Turn a naive UTC datetime, uuid.UUID or TimeUUID column key into a slice bound."""
+        if value is None:
+            return ''
+        elif isinstance(value, datetime):
+            return timestamp.timeUUID(value, lowest=lowest).bytes
+        elif isinstance(value, uuid.UUID):
+            return value.bytes
+        return value
+
+    def iter_between(self, start=None, finish=None, reverse=True, page_size=1000, **kwargs):
+        """Lazily yield the (column_key, value) pairs appended between start and
+           finish, newest first unless reverse is False. Both bounds are
+           optional, inclusive and either naive UTC datetimes or TimeUUIDs."""
+        lower = self.time_bound(start, lowest=True)
+        upper = self.time_bound(finish, lowest=False)
+        if reverse:
+            lower, upper = upper, lower
+        return self.iter_columns(page_size=page_size, reverse=reverse, start=lower, finish=upper, **kwargs)
+
+    def since(self, last, limit=1000, **kwargs):
+        """The (column_key, value) pairs appended after last, oldest first. last
+           is the newest column key seen so far (or a naive UTC datetime), so
+           polling a timeline only transfers what is new."""
+        start = self.time_bound(last, lowest=True)
+        columns = self.get_slice(self.row_key, start=start, reverse=False, count=limit + 1, **kwargs)
+        if columns and columns[0][0] == start:
+            columns = columns[1:]
+        return columns[:limit]
+
 class GeneratedIndex(TimeOrderedIndex):
     __abstract__ = True
\ No newline at end of file
@@ -0,0 +1,90 @@
+import sys
+
+from thrift.Thrift import (TApplicationException,
+                           TMessageType,
+                          )
+from cassandra import Cassandra
+
+from .futures import Future
+
+class Pipeline(object):
+    """Queues calls to a Cassandra.Client and sends them all back to back on
+       execute(), each with its own seqid, before reading the first answer.
+       Answers are matched to their calls by seqid, so it doesn't matter in
+       which order the server sends them. Every call returns a Future.
+
+       Works on any transport, but pays off most on a TFramedTransport,
+       where the server can read the next frame while it works on the last."""
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, attr):
+        assert hasattr(Cassandra.Client, 'send_' + attr), 'Cassandra has no call %s' % (attr,)
+        def queue_call(*args, **kwargs):
+            future = Future()
+            self._calls.append((attr, args, kwargs, future))
+            return future
+
+        setattr(self, attr, queue_call)
+        return getattr(self, attr)
+
+    def __len__(self):
+        return len(self._calls)
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        client = self._client
+        pending = {}
+        try:
+            sends = []
+            for attr, args, kwargs, future in calls:
+                client._seqid += 1
+                pending[client._seqid] = (attr, future)
+                sends.append((client._seqid, attr, args, kwargs))
+            for seqid, attr, args, kwargs in sends:
+                client._seqid = seqid
+                getattr(client, 'send_' + attr)(*args, **kwargs)
+
+            while pending:
+                iprot = client._iprot
+                fname, mtype, rseqid = iprot.readMessageBegin()
+                attr, future = pending.pop(rseqid)
+                if mtype == TMessageType.EXCEPTION:
+                    x = TApplicationException()
+                    x.read(iprot)
+                    iprot.readMessageEnd()
+                    future.set_exception((TApplicationException, x, None))
+                    continue
+                result = getattr(Cassandra, attr + '_result')()
+                result.read(iprot)
+                iprot.readMessageEnd()
+                try:
+                    future.set_result(decode_result(attr, result))
+                except:
+                    future.set_exception(sys.exc_info())
+        except:
+            # the connection is out of sync now, nobody gets an answer anymore.
+            exc_info = sys.exc_info()
+            for attr, future in pending.values():
+                future.set_exception(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return [future for attr, args, kwargs, future in calls]
+
+def decode_result(attr, result):
+    """Does what the generated recv_* methods do for a *_result struct."""
+    returns = False
+    for spec in result.thrift_spec:
+        if spec is None:
+            continue
+        name = spec[2]
+        value = getattr(result, name)
+        if name == 'success':
+            returns = True
+            if value is not None:
+                return value
+        elif value is not None:
+            raise value
+    if returns:
+        raise TApplicationException(TApplicationException.MISSING_RESULT, "%s failed: unknown result" % (attr,))
+    return None
@@ -0,0 +1,79 @@
+import socket
+import time
+
+from thrift import Thrift
+from cassandra.ttypes import (TimedOutException,
+                              UnavailableException,
+                             )
+
+# The connection is gone, but another one (probably to another server) might work.
+TRANSPORT_ERRORS = (Thrift.TException, socket.timeout, socket.error)
+# Cassandra couldn't reach enough replicas in time. Another try might work.
+CASSANDRA_ERRORS = (TimedOutException, UnavailableException)
+
+READ_OPERATIONS = ('get', 'get_slice', 'multiget_slice', 'get_count', 'multiget_count',
+                   'get_range_slices', 'describe_keyspaces', 'describe_keyspace', 'describe_ring',
+                   'describe_cluster_name', 'describe_version', 'describe_splits',
+                   'check_schema_agreement')
+WRITE_OPERATIONS = ('insert', 'remove', 'batch_mutate', 'truncate')
+
+def operation_type(attr):
+    if attr in READ_OPERATIONS:
+        return 'read'
+    elif attr in WRITE_OPERATIONS:
+        return 'write'
+    elif attr.startswith('system_'):
+        return 'schema'
+    return 'other'
+
+class RetryPolicy(object):
+    """Decides how often a call is tried, which errors are worth another try,
+       how long to wait in between and how long a single try may take.
+
+       Retried writes are sent with exactly the arguments of the first try, so
+       every Column keeps the Clock it was given when the mutation was built.
+       Cassandra resolves the duplicates, and nothing gets written twice."""
+    def __init__(self, attempts=3, backoff=0.0, max_backoff=1.0, timeout=None,
+                 retry_on=TRANSPORT_ERRORS + CASSANDRA_ERRORS):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.retry_on = retry_on
+
+    def delay(self, attempt):
+        if not self.backoff:
+            return 0
+        return min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+
+    def call(self, func):
+        """Call func(timeout) until it succeeds or we run out of attempts."""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func(self.timeout)
+            except self.retry_on, exc:
+                if attempt >= self.attempts:
+                    raise
+                delay = self.delay(attempt)
+                if delay:
+                    time.sleep(delay)
+
+class NoRetry(RetryPolicy):
+    def __init__(self, timeout=None):
+        RetryPolicy.__init__(self, attempts=1, timeout=timeout)
+
+class RetryPolicies(object):
+    """One RetryPolicy for each type of operation: read, write, schema and other.
+       Schema changes are only retried if the connection broke."""
+    def __init__(self, read=None, write=None, schema=None, other=None):
+        self.policies = {
+                         'read': read or RetryPolicy(),
+                         'write': write or RetryPolicy(),
+                         'schema': schema or RetryPolicy(attempts=2, retry_on=TRANSPORT_ERRORS),
+                         'other': other or RetryPolicy(retry_on=TRANSPORT_ERRORS),
+                        }
+
+    def policy_for(self, attr):
+        return self.policies[operation_type(attr)]
@@ -0,0 +1,74 @@
+import bisect
+import hashlib
+import threading
+
+from .util import unhandled_exception_handler
+
+TOKEN_SPACE = 2**127
+
+def key_token(row_key):
+    """The RandomPartitioner token of a row key: abs() of the MD5 digest read
+       as a signed 128bit integer, just like Cassandra's BigInteger does it."""
+    if isinstance(row_key, unicode):
+        row_key = row_key.encode('utf-8')
+    value = long(hashlib.md5(row_key).hexdigest(), 16)
+    if value >= TOKEN_SPACE:
+        value -= 2**128
+    return abs(value)
+
+class Ring(object):
+    """Maps row keys to the servers that hold their replicas, as reported by
+       describe_ring. Only correct for the RandomPartitioner."""
+    def __init__(self, token_ranges, port):
+        ranges = sorted(token_ranges, key=lambda tr: long(tr.end_token))
+        self.end_tokens = [long(tr.end_token) for tr in ranges]
+        self.endpoints = [['%s:%s' % (endpoint, port) for endpoint in tr.endpoints] for tr in ranges]
+
+    @classmethod
+    def from_client(cls, client, keyspace, port):
+        return cls(client.describe_ring(keyspace), port)
+
+    def servers(self):
+        seen = set()
+        for endpoints in self.endpoints:
+            seen.update(endpoints)
+        return sorted(seen)
+
+    def replicas(self, row_key):
+        if not self.end_tokens:
+            return []
+        # every range is (start_token, end_token], the last one wraps around.
+        i = bisect.bisect_left(self.end_tokens, key_token(row_key))
+        if i == len(self.end_tokens):
+            i = 0
+        return self.endpoints[i]
+
+    def primary(self, row_key):
+        replicas = self.replicas(row_key)
+        return replicas[0] if replicas else None
+
+class RingRefresher(threading.Thread):
+    """Periodically reloads the token ring of a keyspace in the background.
+       Requests in flight keep using the ring and servers they started with."""
+    def __init__(self, client, keyspace, interval, route=True, discover=False):
+        threading.Thread.__init__(self, name='RingRefresher-%s' % (keyspace,))
+        self.daemon = True
+        self.client = client
+        self.keyspace = keyspace
+        self.interval = interval
+        self.route = route
+        self.discover = discover
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet():
+                break
+            try:
+                self.client.refresh_ring(self.keyspace, route=self.route, discover=self.discover)
+            except Exception:
+                unhandled_exception_handler()
+
+    def stop(self):
+        self._stopped.set()
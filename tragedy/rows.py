@@ -1,6 +1,8 @@
 import functools
 import itertools
+import sys
 import uuid
+from collections import deque
 from cassandra.ttypes import (Column, Clock, ColumnOrSuperColumn, ColumnParent,
     ColumnPath, ConsistencyLevel, NotFoundException, SlicePredicate,
     SliceRange, SuperColumn, CfDef, Mutation)
@@ -23,9 +25,24 @@ from .columns import (ConvertAPI,
                     )
 
 from .exceptions import TragedyException
+from .hedging import Hedger
+from .futures import (default_executor,
+                      SingleFlight,
+                     )
+from .session import current_session
+from .cache import ExpiringCache
+from .batch import (current_batch,
+                    send_mutation_map,
+                   )
+from .writebehind import (defer,
+                          deferring,
+                         )
 
 known_sort_orders = ('BytesType', 'AsciiType', 'UTF8Type', 'LongType', 'LexicalUUIDType', 'TimeUUIDType')
 
+# The reads of all models that are on the wire right now, for _coalesce_reads.
+_inflight = SingleFlight()
+
 class RowKey(ConvertAPI):
     def __init__(self, *args, **kwargs):
         self.autogenerate = kwargs.pop('autogenerate', False)
@@ -64,6 +81,30 @@ class RowDefaults(object):
     _preload_row_cache = False
     _key_cache_size = 200000
     _dont_hash_row_key = False # not in use right now, but we seem to have encoding issues.
+    
+    # Send slow reads to a second server too, if they take longer than this percentile of recent reads.
+    _hedge_reads = False
+    _hedge_percentile = 95
+    
+    # Where the asynchronous API (aload, asave, ...) runs. None is tragedy.futures.default_executor().
+    _executor = None
+    
+    # load_multi fetches this many keys per request, and runs this many requests at once.
+    _load_chunk_size = 1000
+    _load_parallelism = 4
+    
+    # Queue our writes for the keyspace's background writer instead of waiting for them,
+    # like save(async=True) does for single saves. See Keyspace.writer().
+    _write_behind = False
+    
+    # Threads reading the same rows with the same predicate at the same time share a single read.
+    _coalesce_reads = False
+    
+    # Keep up to this many rows (0 doesn't cache), of at most this many bytes (None is unbounded)
+    # for this many seconds (None is until they're evicted or saved) in memory, see multiget_slice.
+    _client_cache_size = 0
+    _client_cache_bytes = None
+    _client_cache_ttl = None
 
     @classmethod
     def _init_class(cls, name=None):
@@ -75,6 +116,12 @@ class RowDefaults(object):
         assert keyspaces, 'No Keyspaces defined - make sure you define one before defining modules.'
         cls._keyspace = getattr(cls, '_keyspace', keyspaces[0])
         cls.save_hooks = OrderedSet()
+        cls._hedger = Hedger(percentile=cls._hedge_percentile)
+        cls._client_cache = None
+        if cls._client_cache_size:
+            cls._client_cache = ExpiringCache(cls._client_cache_size, cls._client_cache_ttl,
+                                              max_bytes=cls._client_cache_bytes,
+                                              sizeof=cls._cached_size, group=lambda key: key[0])
         cls._keyspace.register_model(getattr(cls, '_column_family', name), cls)
     
     @classmethod
@@ -86,6 +133,12 @@ class RowDefaults(object):
     def getclient(cls):
         return cls._keyspace.getclient()
     
+    @classmethod
+    def _submit(cls, func, *args, **kwargs):
+        """Run func on our executor and return a Future of its result."""
+        assert cls.getclient().thread_safe, 'The asynchronous API needs a thread safe connection (pool or thread_local).'
+        return (cls._executor or default_executor()).submit(func, *args, **kwargs)
+    
     # Default Consistency levels that have overrides.
     _read_consistency_level=ConsistencyLevel.ONE
     _write_consistency_level=ConsistencyLevel.ONE
@@ -107,6 +160,28 @@ class RowDefaults(object):
                       )
         return cfdef
     
+    @classmethod
+    def batch_mutate(cls, mutation_map, consistency_level=None):
+        """Send a mutation_map, split up by the servers that own its row keys.
+           Inside a Keyspace.batch() it's added to the batch instead, and with
+           write-behind it's queued for the keyspace's writer."""
+        batch = current_batch(cls._keyspace)
+        if batch is not None:
+            batch.add(cls, mutation_map, cls._wcl(consistency_level))
+            return
+        if cls._write_behind or deferring():
+            cls._keyspace.writer().put(cls, mutation_map, cls._wcl(consistency_level))
+            return
+        send_mutation_map(cls.getclient(), mutation_map, cls._wcl(consistency_level))
+        for row_key in mutation_map:
+            cls._invalidate(row_key)
+    
+    @classmethod
+    def _invalidate(cls, row_key):
+        """row_key was written to, forget what we cached about it."""
+        if cls._client_cache is not None:
+            cls._client_cache.drop_group(row_key)
+    
     @classmethod
     def register_columnfamiliy_with_cassandra(cls):
         cfdef = cls.asCfDef()
@@ -127,6 +202,9 @@ class BasicRow(RowDefaults):
         self.column_spec     = {}  #
         
         self.mirrors = OrderedSet()
+        
+        # Rows our ForeignKeys point to, if they were prefetched. column_key -> row
+        self._prefetched = {}
                 
         # Our Row Key
         self.row_key = row_key
@@ -188,6 +266,7 @@ class BasicRow(RowDefaults):
         assert isinstance(column_key, basestring), "Column Key needs to be a string."
         self.ordered_columnkeys.add(column_key)
         self.column_values[column_key] = value
+        self._prefetched.pop(column_key, None)
         
         if dont_mark:
             self.unmarkChanged(column_key)
@@ -286,8 +365,7 @@ class BasicRow(RowDefaults):
         self.column_changed[column_key] = True
 
     def unmarkChanged(self, column_key):
-        if column_key in self.column_changed:
-            del self.column_changed[column_key]
+        self.column_changed.pop(column_key, None) # the writer thread may unmark, too
 
     def delete(self, column_key):
         # XXX: keep track of delete
@@ -313,7 +391,7 @@ class BasicRow(RowDefaults):
     @staticmethod
     def get_slice_predicate(column_names=None, start='', finish='', reverse=True, count=10000, *args, **kwargs):
         if column_names:
-            return SlicePredicate(column_names=columns)
+            return SlicePredicate(column_names=column_names)
             
         slice_range = SliceRange(start=start, finish=finish, reversed=reverse, count=count)
         return SlicePredicate(slice_range=slice_range)
@@ -324,39 +402,131 @@ class BasicRow(RowDefaults):
         return (colOrSuper.column.name, colOrSuper.column.value)
         
     @classmethod
-    def load_multi(cls, ordered=True, *args, **kwargs):
-        unordered = {}
-        if not kwargs['keys']:
+    def load_multi(cls, ordered=True, chunk_size=None, parallelism=None, *args, **kwargs):
+        """Yield the rows for kwargs['keys']. Keys are fetched chunk_size at a
+           time, with up to parallelism chunks in flight, so only a few chunks
+           sit in memory at once. ordered yields the rows in the order of keys.
+           prefetch is a list of ForeignKey fields whose rows are loaded along
+           with each chunk, see prefetch(). Inside a Session, whole rows it
+           already knows aren't fetched again, and we yield its instances."""
+        keys = kwargs.pop('keys')
+        prefetch = kwargs.pop('prefetch', None)
+        if not keys:
             raise StopIteration
 
-        for row_key in kwargs['keys']:
+        for row_key in keys:
             assert row_key, 'Empty row_key %s' % (row_key,)
             assert isinstance(row_key, basestring), 'Row Key %s is of type %s should be basestring.' % (row_key, type(row_key,))
         
-        for row_key, columns in cls.multiget_slice(*args, **kwargs):
-            columns = OrderedDict(columns)
-            columns['row_key'] = row_key
-            columns['access_mode'] = 'to_identity'
-            columns['_for_loading'] = True
+        session = current_session() if not (args or kwargs) else None
+        known = {} # row_key -> row, from the session
+        if session is not None:
+            for row_key in keys:
+                if session.get(cls, row_key) is not None:
+                    known[row_key] = session.get(cls, row_key)
+        if known:
+            if prefetch:
+                cls.prefetch(known.values(), prefetch)
             if not ordered:
-                yield cls( **columns)
-            else:
-                unordered[row_key] = columns
+                for row in known.values():
+                    yield row
+        missing = [row_key for row_key in keys if row_key not in known]
         
-        if not ordered:
-            raise StopIteration
+        chunk_size = chunk_size or cls._load_chunk_size
+        chunks = [missing[i:i+chunk_size] for i in xrange(0, len(missing), chunk_size)]
+        
+        position = 0 # of the next key to yield, if we need to mix in known rows
+        for chunk, fetched in cls._fetch_chunks(chunks, parallelism, *args, **kwargs):
+            if ordered:
+                unordered = dict(fetched)
+                fetched = [(row_key, unordered.get(row_key, [])) for row_key in chunk]
+            
+            rows = [cls( **cls._loading_kwargs(row_key, columns) ) for row_key, columns in fetched]
+            if session is not None:
+                rows = [session.add(row) for row in rows]
+            if prefetch:
+                cls.prefetch(rows, prefetch)
+            if not (ordered and known):
+                for row in rows:
+                    yield row
+                continue
             
-        for row_key in kwargs['keys']:
-            blah = unordered.get(row_key)
-            yield cls( **blah )
+            known.update((row.row_key, row) for row in rows)
+            while position < len(keys) and keys[position] in known:
+                yield known[keys[position]]
+                position += 1
+        
+        if ordered and known:
+            for row_key in keys[position:]:
+                yield known[row_key]
+    
+    @classmethod
+    def prefetch(cls, rows, fields):
+        """Load the rows that the ForeignKey fields of rows point to, with one
+           load_multi per target model, and attach them to rows. get() returns
+           the attached row instead of a new, empty instance."""
+        wanted = OrderedDict() # foreign_class -> (fields, row keys)
+        for field in fields:
+            spec = getattr(cls, field, None)
+            assert isinstance(spec, ForeignKey), '%s.%s is not a ForeignKey.' % (cls.__name__, field)
+            names, keys = wanted.setdefault(spec.foreign_class, ([], OrderedSet()))
+            names.append(field)
+            for row in rows:
+                if row.get_value_for_columnkey(field):
+                    keys.add(row.get_value_for_columnkey(field))
+        
+        for foreign_class, (names, keys) in wanted.items():
+            if not keys:
+                continue
+            targets = dict((target.row_key, target) for target in foreign_class.load_multi(keys=list(keys)))
+            for row in rows:
+                for field in names:
+                    target = targets.get(row.get_value_for_columnkey(field))
+                    if target is not None:
+                        row._prefetched[field] = target
+    
+    @classmethod
+    def _fetch_chunks(cls, chunks, parallelism=None, *args, **kwargs):
+        """Yield (chunk, [(row_key, columns), ...]) for each chunk, in order."""
+        parallelism = parallelism or cls._load_parallelism
+        executor = cls._executor or default_executor()
+        fetch = lambda chunk: list(cls.multiget_slice(keys=chunk, *args, **kwargs))
+        
+        if len(chunks) == 1 or parallelism <= 1 or not cls.getclient().thread_safe or executor.in_worker():
+            for chunk in chunks:
+                yield chunk, fetch(chunk)
+            raise StopIteration
+        
+        inflight = deque()
+        chunks = iter(chunks)
+        for chunk in itertools.islice(chunks, parallelism):
+            inflight.append((chunk, executor.submit(fetch, chunk)))
+        while inflight:
+            chunk, future = inflight.popleft()
+            fetched = future.result()
+            for next_chunk in itertools.islice(chunks, 1):
+                inflight.append((next_chunk, executor.submit(fetch, next_chunk)))
+            yield chunk, fetched
+    
+    @staticmethod
+    def _loading_kwargs(row_key, columns):
+        columns = OrderedDict(columns)
+        columns['row_key'] = row_key
+        columns['access_mode'] = 'to_identity'
+        columns['_for_loading'] = True
+        return columns
     
     def load(self, *args, **kwargs):
         if not self.row_key and self._row_key_spec.default:
                 self.row_key = self._row_key_spec.get_default()
         assert self.row_key, 'No row_key and no non-null non-empty keys argument. Did you use the right row_key_name?'
         tkeys = [self.row_key]
-        result = list(self.load_multi(keys=tkeys))
-        self._update(result[0].column_values, _for_loading=True)
+        result = list(self.load_multi(keys=tkeys, prefetch=kwargs.get('prefetch')))
+        if result[0] is not self:
+            self._update(result[0].column_values, _for_loading=True)
+            self._prefetched.update(result[0]._prefetched)
+        if current_session() is not None:
+            return result[0] # the session's instance for our row_key
         return self
         # # print self, dir(self), self._row_key_name
         # assert self.row_key, 'No row_key and no non-null non-empty keys argument. Did you use the right row_key_name?'
@@ -374,29 +544,141 @@ class BasicRow(RowDefaults):
         # return self
         
     @classmethod
-    def multiget_slice(cls, keys=None, consistency_level=None, **kwargs):
+    def aload_multi(cls, *args, **kwargs):
+        """Like load_multi, but returns a Future of the list of rows."""
+        return cls._submit(lambda: list(cls.load_multi(*args, **kwargs)))
+    
+    def aload(self, *args, **kwargs):
+        """Like load, but returns a Future of the loaded row."""
+        return self._submit(self.load, *args, **kwargs)
+    
+    @classmethod
+    def get_slice(cls, key, consistency_level=None, **kwargs):
+        """The (column_key, value) pairs of one row that match the predicate."""
+        predicate = cls.get_slice_predicate(**kwargs)
+        client = cls.getclient()
+        for server, server_keys in client.split_keys([key]):
+            columns = client.on(server).get_slice(key              = key,
+                                                  column_parent    = cls.column_parent(),
+                                                  predicate        = predicate,
+                                                  consistency_level=cls._rcl(consistency_level),
+                                                 )
+            return [cls.decodeColumn(col) for col in columns]
+    
+    @classmethod
+    def hedge_stats(cls):
+        return dict(cls._hedger.stats)
+    
+    @classmethod
+    def cache_stats(cls):
+        """Hits, misses, evictions and expirations of our row cache, and what it holds now."""
+        if cls._client_cache is None:
+            return None
+        stats = dict(cls._client_cache.stats)
+        stats.update(rows=len(cls._client_cache), bytes=cls._client_cache.bytes)
+        return stats
+    
+    @staticmethod
+    def _cached_size(key, columns):
+        row_key, predicate = key
+        return len(row_key) + sum(len(column_key) + len(value) for column_key, value in columns)
+    
+    @classmethod
+    def multiget_slice(cls, keys=None, consistency_level=None, hedge=None, **kwargs):
+        """Yield (row_key, [(column_key, value), ...]) for keys. With a row cache,
+           keys whose answer to this predicate is cached don't go over the
+           wire. Reads with an explicit consistency_level always do."""
         assert keys, 'Need a non-null non-empty keys argument.'
         # print 'GETTING', cls, keys, kwargs
         
         predicate = cls.get_slice_predicate(**kwargs)
-        key_slices = cls.getclient().multiget_slice(    #  keyspace          = str(cls._keyspace),
-                                                      keys              = keys,
-                                                      column_parent     = cls.column_parent(),
-                                                      predicate         = predicate,
-                                                      consistency_level=cls._rcl(consistency_level),
-                                                     )
-        if key_slices:
-            for row_key, columns in key_slices.iteritems():
-                yield row_key, [cls.decodeColumn(col) for col in columns]
+        cache = cls._client_cache if consistency_level is None else None
+        if cache is not None:
+            token = cache.token() # a save while we read makes what we read too old to cache
+            cache_predicate = repr(predicate)
+            missing = []
+            for row_key in keys:
+                columns = cache.get((row_key, cache_predicate))
+                if columns is None:
+                    missing.append(row_key)
+                else:
+                    yield row_key, columns
+            keys = missing
+            if not keys:
+                raise StopIteration
+        
+        if cls._coalesce_reads:
+            fetched = cls._coalesced_slices(keys, predicate, consistency_level, hedge)
+        else:
+            fetched = cls._fetch_slices(keys, predicate, consistency_level, hedge)
+        for row_key, columns in fetched:
+            if cache is not None:
+                cache.set((row_key, cache_predicate), columns, token)
+            yield row_key, columns
+    
+    @classmethod
+    def _fetch_slices(cls, keys, predicate, consistency_level=None, hedge=None):
+        client = cls.getclient()
+        hedge = cls._hedge_reads if hedge is None else hedge
+        for server, server_keys in client.split_keys(keys):
+            def fetch(server, server_keys=server_keys):
+                return client.on(server).multiget_slice(    #  keyspace          = str(cls._keyspace),
+                                                        keys              = server_keys,
+                                                        column_parent     = cls.column_parent(),
+                                                        predicate         = predicate,
+                                                        consistency_level=cls._rcl(consistency_level),
+                                                       )
+            if hedge:
+                primary, secondary = client.hedge_servers(server, server_keys)
+                key_slices = cls._hedger.call(functools.partial(fetch, primary), 
+                                              secondary and functools.partial(fetch, secondary))
+            else:
+                key_slices = fetch(server)
+            if key_slices:
+                for row_key, columns in key_slices.iteritems():
+                    yield row_key, [cls.decodeColumn(col) for col in columns]
         #     key, value = result[0], [(colOrSuper.column.name, colOrSuper.column.value) for \
         #                         colOrSuper in result[1]]
         #     yield key, value
+    
+    @classmethod
+    def _coalesced_slices(cls, keys, predicate, consistency_level=None, hedge=None):
+        """Like _fetch_slices, but keys another thread is reading with the same
+           predicate right now aren't read again, we wait for its answer."""
+        flight_key = lambda row_key: (cls._column_family, row_key, repr(predicate), consistency_level)
+        ours, theirs = _inflight.claim([flight_key(row_key) for row_key in keys])
+        results = {}
+        try:
+            if ours:
+                results = dict(cls._fetch_slices([key[1] for key in ours], predicate, consistency_level, hedge))
+        except:
+            _inflight.finish(ours, exc_info=sys.exc_info())
+            raise
+        _inflight.finish(ours, dict((flight_key(row_key), columns) for row_key, columns in results.iteritems()))
+        
+        for row_key, columns in results.iteritems():
+            yield row_key, columns
+        for key, future in theirs.iteritems():
+            columns = future.result()
+            if columns is not None:
+                yield key[1], columns
 
 # ----- Save Data -----
     def generate_row_key(self):
         self.row_key = uuid.uuid4().hex
 
+    def asave(self, *args, **kwargs):
+        """Like save, but returns a Future of the saved row."""
+        return self._submit(self.save, *args, **kwargs)
+
     def save(self, *args, **kwargs):
+        """Write our changed columns, to our row_key and all mirrors, and run
+           the save hooks. With async=True, all of that is only queued for the
+           keyspace's background writer, see Keyspace.writer()."""
+        if kwargs.pop('async', False):
+            with defer():
+                return self.save(*args, **kwargs)
+        
         if not kwargs.get('write_consistency_level'):
             kwargs['write_consistency_level'] = None
         
@@ -421,32 +703,53 @@ class BasicRow(RowDefaults):
         return self
         
     def _real_save(self, save_row_key=None, *args, **kwargs):
+        mumap = self._mutation_map(save_row_key)
+        # print u'MUMAP', repr(mumap).encode('ascii', 'replace')
+        session = current_session()
+        if session is not None:
+            session.discard(self, save_row_key)
+        
+        # Nothing's sent yet inside a batch or with write-behind, they call _saved once it is.
+        batch = current_batch(self._keyspace)
+        if batch is None and (self._write_behind or deferring()):
+            self._keyspace.writer().put(self.__class__, mumap, self._wcl(kwargs['write_consistency_level']),
+                                        saved=(self, save_row_key, self._changed_columns()))
+            return
+        self.batch_mutate(mumap, consistency_level=kwargs['write_consistency_level'])
+        if batch is not None:
+            batch.saved(self, save_row_key)
+        else:
+            self._saved(save_row_key)
+
+    def _changed_columns(self):
+        """column_key -> value of our changed columns, see _saved."""
+        return dict((column_key, self.get_value_for_columnkey(column_key))
+                    for column_key in self.column_changed.keys())
+
+    def _saved(self, save_row_key, columns=None):
+        """We were written to save_row_key. With columns, from _changed_columns()
+           when the write was queued, only those that haven't been set again
+           since stop counting as changed, otherwise all of them do."""
+        # reset 'changed' - nothing's changed anymore
+        if columns is None:
+            self.column_changed.clear()
+            return
+        for column_key, value in columns.iteritems():
+            if self.get_value_for_columnkey(column_key) is value:
+                self.unmarkChanged(column_key)
+
+    def _mutation_map(self, save_row_key):
+        """The mutation_map that writes our changed columns to save_row_key."""
         save_columns = []
         for column_key, value in self.yield_column_key_value_pairs(for_saving=True):
             assert isinstance(value, basestring), 'Not basestring %s:%s (%s)' % (column_key, type(value), type(self))
             newtimestamp = self._timestamp_func()
-            import time
             # print 'STORING WITH NEWTIMESTAMP', self.__class__, column_key, newtimestamp #time.ctime( int(newtimestamp) ) 
             column = Column(name=column_key, value=value, clock=Clock(timestamp=newtimestamp))
             save_columns.append( ColumnOrSuperColumn(column=column) )
         
         save_mutations = [Mutation(column_or_supercolumn=sc) for sc in save_columns]
-        
-        # self.getclient().batch_insert(#keyspace         = str(self._keyspace),
-        #                          key              = save_row_key,
-        #                          cfmap            = {self._column_family: save_columns},
-        #                          consistency_level= self._wcl(kwargs['write_consistency_level']),
-        #                         )
-        mumap = {save_row_key: {self._column_family: save_mutations} }
-        # print u'PREMUMAP', unicode(save_mutations).encode('ascii', 'replace')
-        # print u'MUMAP', repr(mumap).encode('ascii', 'replace')
-        self.getclient().batch_mutate(
-                                      mutation_map=mumap,
-                                      consistency_level=self._wcl(kwargs['write_consistency_level']),
-                                     )
-        
-        # reset 'changed' - nothing's changed anymore
-        self.column_changed.clear()
+        return {save_row_key: {self._column_family: save_mutations} }
 
 # ----- Display -----
         
@@ -482,6 +785,9 @@ class DictRow(BasicRow):
     def get(self, column_key, default=None, **kwargs):
         access_mode = kwargs.pop('access_mode', 'to_external')
         
+        if access_mode == 'to_external' and column_key in self._prefetched:
+            return self._prefetched[column_key]
+        
         spec = self.get_spec_for_columnkey(column_key)
         value = self.get_value_for_columnkey(column_key)
         if not (value is None):
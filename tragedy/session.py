@@ -0,0 +1,50 @@
+import threading
+
+_local = threading.local()
+
+def current_session():
+    """The innermost Session of this thread, or None."""
+    sessions = getattr(_local, 'sessions', None)
+    return sessions[-1] if sessions else None
+
+class Session(object):
+    """An identity map for the rows loaded in one unit of work, e.g. a web request:
+
+        with Session():
+            ...
+
+       Inside, load, load_multi and Index.resolve fetch each row at most once
+       and always hand out the same instance for it. Only whole rows go into
+       the map, loads with a slice predicate bypass it. Sessions are per thread."""
+    def __init__(self):
+        self._rows = {} # (column_family, row_key) -> row
+
+    def __enter__(self):
+        if getattr(_local, 'sessions', None) is None:
+            _local.sessions = []
+        _local.sessions.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.sessions.remove(self)
+        return False
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, cls, row_key):
+        return self._rows.get((cls._column_family, row_key))
+
+    def add(self, row):
+        """Remember row, unless we already have one for its key. Returns the one we keep."""
+        return self._rows.setdefault((row._column_family, row.row_key), row)
+
+    def discard(self, row, row_key=None):
+        """Forget our row for row_key (row's own by default) unless it is row,
+           because row was just saved there and ours is out of date."""
+        key = (row._column_family, row_key or row.row_key)
+        if self._rows.get(key) is not row:
+            self._rows.pop(key, None)
+
+    def clear(self):
+        self._rows.clear()
@@ -130,6 +130,32 @@ def exportUUID(timestamp):
 def fromUUID(uuinp):
     return exportUnix(importUUID( uuinp.time),microseconds=True)
 
+def timeUUID(t, lowest=True):
+    """
+    The lowest (or highest) version 1 UUID for the naive UTC datetime t. Every
+    TimeUUID generated during t sorts after the lowest and before the highest,
+    which makes them good bounds for slicing TimeUUIDType columns.
+
+    >>> timeUUID(datetime(2010, 6, 1, 12, 0))
+    UUID('3445e000-6d75-11df-8000-000000000000')
+    >>> timeUUID(datetime(2010, 6, 1, 12, 0), lowest=False)
+    UUID('3445e009-6d75-11df-bfff-ffffffffffff')
+    >>> importUUID(timeUUID(datetime(2010, 6, 1, 12, 0)).time)
+    datetime.datetime(2010, 6, 1, 12, 0)
+    """
+    timestamp = exportUUID(t)
+    if not lowest:
+        timestamp += 9 # datetime stops at microseconds, UUIDs count in 100ns
+    time_low = timestamp & 0xffffffffL
+    time_mid = (timestamp >> 32) & 0xffffL
+    time_hi_version = ((timestamp >> 48) & 0x0fffL) | (1 << 12)
+    if lowest:
+        clock_seq_hi_variant, clock_seq_low, node = 0x80, 0x00, 0x0L
+    else:
+        clock_seq_hi_variant, clock_seq_low, node = 0xbf, 0xff, 0xffffffffffffL
+    return uuid.UUID(fields=(time_low, time_mid, time_hi_version, 
+                             clock_seq_hi_variant, clock_seq_low, node))
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,183 @@
+import sys
+import threading
+import time
+from Queue import Queue, Empty
+
+from .batch import (chunk_mutation_map,
+                    coalesce_mutation_map,
+                    count_mutations,
+                    merge_mutation_map,
+                    send_mutation_map,
+                   )
+
+_local = threading.local()
+
+def deferring():
+    """True if this thread is inside a defer() block."""
+    return getattr(_local, 'depth', 0) > 0
+
+class defer(object):
+    """Inside this block, batch_mutate hands its writes to the keyspace's
+       WriteBehind instead of sending them. save(async=True) uses it."""
+    def __enter__(self):
+        _local.depth = getattr(_local, 'depth', 0) + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.depth -= 1
+        return False
+
+class _Marker(object):
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.done = threading.Event()
+
+class WriteBehind(object):
+    """Sends the writes of a keyspace from a background thread, so callers
+       don't wait for them. Queued mutation_maps are merged by row and column
+       family and sent once batch_size mutations are pending, or interval
+       seconds after the first of them was queued, whichever comes first.
+       With coalesce, a column written several times in that window is only
+       sent once, with the value of the highest clock, which saves a lot of
+       writes on hot rows.
+
+       Once max_pending writes are queued, put() blocks until the thread
+       catches up. flush() waits until everything queued so far has been sent
+       and raises the first error since the last flush(); join() also stops
+       the thread. Writes that are queued aren't visible to reads yet, ask
+       has_column(). Saved rows keep their columns marked as changed until
+       they are sent, so if that fails, saving them again retries it.
+
+       The thread shares the keyspace's connection, which has to be thread
+       safe (pool or thread_local)."""
+    def __init__(self, keyspace, max_pending=10000, batch_size=500, interval=0.05, coalesce=True):
+        self.keyspace = keyspace
+        self.batch_size = batch_size
+        self.interval = interval
+        self.coalesce = coalesce
+        self._queue = Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._errors = []
+        self._columns = {} # (column_family, row_key, column name) -> times queued and not sent yet
+        self.stats = {'queued': 0, 'batches': 0, 'mutations': 0, 'coalesced': 0, 'errors': 0}
+
+    def put(self, model, mutation_map, consistency_level, saved=None):
+        """Queue mutation_map. saved is (row, row_key, row._changed_columns())
+           if it saves row to row_key: row._saved() is called once it's sent."""
+        assert self.keyspace.getclient().thread_safe, 'Write-behind needs a thread safe connection (pool or thread_local).'
+        self._start()
+        columns = [(column_family, row_key, mutation.column_or_supercolumn.column.name)
+                   for row_key, cfs in mutation_map.iteritems()
+                   for column_family, mutations in cfs.iteritems()
+                   for mutation in mutations
+                   if mutation.column_or_supercolumn and mutation.column_or_supercolumn.column]
+        with self._lock:
+            for column in columns:
+                self._columns[column] = self._columns.get(column, 0) + 1
+            self.stats['queued'] += 1
+        self._queue.put((model, mutation_map, consistency_level, columns, saved))
+
+    def has_column(self, column_family, row_key, column_key):
+        """True if we're about to write column_key to row_key."""
+        with self._lock:
+            return (column_family, row_key, column_key) in self._columns
+
+    def flush(self):
+        """Wait until everything queued so far has been sent, and raise the
+           first error since the last flush(). Writes that failed aren't
+           retried, but the rows they saved still count as changed."""
+        self._wait_for(_Marker())
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def join(self):
+        if self._thread is not None:
+            self._wait_for(_Marker(stop=True))
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _wait_for(self, marker):
+        if self._thread is None:
+            return
+        self._queue.put(marker)
+        marker.done.wait()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='tragedy-writebehind-%s' % (self.keyspace,))
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        pending = {} # consistency_level -> mutation_map
+        positions = {} # consistency_level -> positions, see coalesce_mutation_map
+        written = set() # (model, row_key)
+        columns = [] # see put()
+        saved = [] # see put()
+        count, deadline = 0, None
+        while True:
+            timeout = max(0, deadline - time.time()) if deadline is not None else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = None # time's up
+
+            if isinstance(item, _Marker) or item is None:
+                self._send(pending, written, columns, saved)
+                pending, positions, written, columns, saved, count, deadline = {}, {}, set(), [], [], 0, None
+                if item is not None:
+                    item.done.set()
+                    if item.stop:
+                        break
+                continue
+
+            model, mutation_map, consistency_level, item_columns, item_saved = item
+            count += count_mutations(mutation_map)
+            if self.coalesce:
+                coalesced = coalesce_mutation_map(pending.setdefault(consistency_level, {}), mutation_map,
+                                                  positions.setdefault(consistency_level, {}))
+                count -= coalesced
+                with self._lock:
+                    self.stats['coalesced'] += coalesced
+            else:
+                merge_mutation_map(pending.setdefault(consistency_level, {}), mutation_map)
+            written.update((model, row_key) for row_key in mutation_map)
+            columns.extend(item_columns)
+            if item_saved is not None:
+                saved.append(item_saved)
+            if deadline is None:
+                deadline = time.time() + self.interval
+            if count >= self.batch_size:
+                self._send(pending, written, columns, saved)
+                pending, positions, written, columns, saved, count, deadline = {}, {}, set(), [], [], 0, None
+
+    def _send(self, pending, written, columns, saved):
+        failed = set() # row keys that were in a chunk that failed
+        for consistency_level, mutation_map in pending.items():
+            for chunk in chunk_mutation_map(mutation_map, self.batch_size):
+                try:
+                    send_mutation_map(self.keyspace.getclient(), chunk, consistency_level)
+                except:
+                    with self._lock:
+                        self._errors.append(sys.exc_info())
+                        self.stats['errors'] += 1
+                    failed.update(chunk)
+                    continue
+                with self._lock:
+                    self.stats['batches'] += 1
+                    self.stats['mutations'] += count_mutations(chunk)
+        for model, row_key in written:
+            model._invalidate(row_key)
+        for row, row_key, row_columns in saved:
+            if row_key not in failed:
+                row._saved(row_key, row_columns)
+        with self._lock:
+            for column in columns:
+                self._columns[column] -= 1
+                if not self._columns[column]:
+                    del self._columns[column]